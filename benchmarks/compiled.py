@@ -0,0 +1,61 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Check that the compiled matrix of each model gives the same probabilities as the Matrix created with
+# maximum_likelihood_probabilities() from its training state, as the detection always did. The states scored are the
+# training state of each model, its first prefixes, the windows of the states of the other models and random states, some
+# with letters that are not in the alphabet.
+# Usage: ./benchmarks/compiled.py [-m models] [-r random states]
+
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules.markov_models_1 import __markov_models__, Model
+import stf.common.markov_chains as mc
+
+
+def get_states(models, amount):
+    """ The states to score with each model """
+    generator = random.Random(0)
+    states = ['', mc.ALPHABET[0]]
+    for model in models:
+        state = model.get_state()
+        states.append(state)
+        states.extend([state[:length] for length in xrange(2, min(len(state), 1000), 50)])
+        states.extend([state[start:start + 50] for start in xrange(0, len(state), 1000)])
+    for index in xrange(amount):
+        states.append(''.join(generator.choice(mc.ALPHABET + '#') for letter in xrange(generator.randint(2, 200))))
+    return states
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models', help='Folder with the models.', action='store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models'), required=False)
+    parser.add_argument('-r', '--random', help='Amount of random states to score.', action='store', default=1000, required=False, type=int)
+    args = parser.parse_args()
+
+    __markov_models__.quiet = True
+    if not __markov_models__.set_models_folder(args.models):
+        sys.exit(-1)
+    models = [model for model in __markov_models__.models if model.compiled]
+    states = get_states(models, args.random)
+    print '{} models compiled of {}. {} states scored with each one.'.format(len(models), len(__markov_models__.models), len(states))
+
+    # The Matrix of the whole training state, as compile() creates it
+    matrices = []
+    for model in models:
+        matrix = Model(model.get_id())
+        matrix.create(model.get_state())
+        matrices.append(matrix)
+    results = []
+    for (name, scorers, function) in [('Matrix', matrices, Model.compute_probability), ('Compiled', models, Model.compute_compiled_probability)]:
+        start = time.time()
+        results.append([function(scorer, state) for scorer in scorers for state in states])
+        print '{}: {:.0f} states/sec'.format(name, len(results[-1]) / (time.time() - start))
+    # Both must give exactly the same log probs
+    differences = sum(1 for (first, second) in zip(results[0], results[1]) if first != second)
+    print 'Different probabilities: {}'.format(differences)
@@ -0,0 +1,191 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Generate flows in the format of ra.conf, for the benchmarks. The tuples are periodic (a period, size and duration
+# that most of their flows keep), random (random times between flows, sizes and durations), or malicious: they replay
+# the letters of the state of a model, so the models should detect them. The malicious tuples come from 10.66.x.x and
+# the rest from 10.0.x.x. The same arguments and seed always give the same flows.
+# Usage: ./benchmarks/generator.py [-l flows] [-t tuples] [-r flows per second] [-p periodic fraction] [-P tcp=0.8,udp=0.2] [-m models] [-M malicious tuples] [-s seed] > file
+
+import argparse
+import heapq
+import os
+import random
+import re
+import sys
+from datetime import datetime
+from datetime import timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slips import LetterEncoder
+
+STARTTIME = datetime(2016, 1, 1)
+# The destination ports of each protocol
+PORTS = {'tcp': ['80', '443', '8080', '25'], 'udp': ['53', '123', '1900']}
+# The letters of a state, with the hours without flows before them and their symbol
+LETTER = re.compile(r'(0*)([1-9a-iA-Ir-zR-Z])([.,+*]?)')
+# Source of the malicious tuples
+MALICIOUS_NETWORK = '10.66'
+
+
+def parse_mix(text):
+    """ The fraction of each protocol from a text like tcp=0.8,udp=0.2 """
+    mix = []
+    for item in text.split(','):
+        (protocol, fraction) = item.split('=')
+        if protocol.strip() not in PORTS:
+            raise ValueError('Unknown protocol {}. Use {}'.format(protocol, ', '.join(sorted(PORTS))))
+        mix.append((protocol.strip(), float(fraction)))
+    return mix
+
+
+def get_model_states(folder):
+    """ The label, protocol and state of each model of the folder or bundle """
+    from modules.markov_models_1 import __markov_models__
+    __markov_models__.quiet = True
+    if not __markov_models__.set_models_folder(folder):
+        return []
+    return [(model.get_label(), model.get_protocol().lower(), model.get_state()) for model in __markov_models__.models if model.get_protocol().lower() in PORTS]
+
+
+class StateReplayer(object):
+    """
+    The flows that give the letters of a state. The letter says the size, the duration and how periodic the time since
+    the previous flow is compared with the one before, and the symbol after it says the time since the previous flow.
+    They are chosen in the middle of the ranges of the thresholds of the encoder.
+    """
+    def __init__(self, state, encoder):
+        self.encoder = encoder
+        self.letters = LETTER.findall(state)
+        # The first two letters are of a new tuple. The replay starts again after them
+        self.position = 0
+        self.T2 = False
+        # The size, duration and periodicity of each letter
+        self.values = {}
+        for (periodic, letters) in encoder.LETTERS.iteritems():
+            for (index, letter) in enumerate(letters):
+                self.values[letter] = (periodic, index / 3 + 1, index % 3 + 1)
+
+    def get_middle(self, limits, position, last=10.0):
+        """ A value in the middle of the range of this position of the limits of a threshold """
+        low = limits[position - 1] if position > 0 else 0.0
+        high = limits[position] if position < len(limits) else low * last
+        return (low + high) / 2
+
+    def get_time(self, zeros, periodic, symbol):
+        """ The time since the previous flow that gives the symbol and, with the previous one, the periodicity """
+        if not symbol:
+            # More than the last threshold, one hour for each 0
+            return self.encoder.tto * max(len(zeros), 1) + self.encoder.tto / 2
+        position = self.encoder.SYMBOLS.index(symbol)
+        low = self.encoder.symbol_limits[position - 1] if position > 0 else 0.0
+        high = self.encoder.symbol_limits[position]
+        if not isinstance(self.T2, bool) and self.T2 > 0 and periodic > 0:
+            # The ratios with the previous time that give the periodicity. Longer or shorter than the previous time,
+            # and in the range of the symbol
+            limits = [1.0, self.encoder.tt1] + self.encoder.periodic_limits + [self.encoder.periodic_limits[-1] * 100]
+            (ratio_low, ratio_high) = (limits[periodic - 1], limits[periodic])
+            for (start, end) in [(self.T2 * ratio_low, self.T2 * ratio_high), (self.T2 / ratio_high, self.T2 / ratio_low)]:
+                (start, end) = (max(start, low), min(end, high))
+                if start < end:
+                    return (start + end) / 2
+        return (low + high) / 2
+
+    def next_flow(self):
+        """ The time since the previous flow, the size and the duration of the next flow """
+        if self.position == len(self.letters):
+            self.position = min(2, len(self.letters) - 1)
+        (zeros, letter, symbol) = self.letters[self.position]
+        (periodic, size, duration) = self.values[letter]
+        if self.position == 0:
+            time = 0.0
+        else:
+            # The symbol after the letter is the one of the time since the previous flow
+            time = self.get_time(zeros, periodic, symbol)
+        self.T2 = time
+        self.position += 1
+        return (time, self.get_middle(self.encoder.size_limits, size - 1), self.get_middle(self.encoder.duration_limits, duration - 1))
+
+
+class FlowGenerator(object):
+    """
+    Flows of many tuples, sorted by time. The periodic and random tuples send about rate flows per second together.
+    The malicious tuples send their flows at the times of their state
+    """
+    def __init__(self, amount_of_tuples=1000, rate=100.0, periodic=0.5, protocols=[('tcp', 0.8), ('udp', 0.2)], states=[], malicious=0, seed=1):
+        self.random = random.Random(seed)
+        self.encoder = LetterEncoder()
+        # Time of the next flow of each tuple, with its number and the size and duration of the flow
+        self.tuples = []
+        self.values = []
+        for index in xrange(amount_of_tuples + malicious):
+            if index < malicious and states:
+                (label, protocol, state) = states[index % len(states)]
+                kind = StateReplayer(state, self.encoder)
+                src_ip = '{}.{}.{}'.format(MALICIOUS_NETWORK, index / 250 % 250, index % 250 + 1)
+            else:
+                protocol = self.choose(protocols)
+                src_ip = '10.0.{}.{}'.format(index / 250 % 250, index % 250 + 1)
+                # The mean time between the flows of each tuple, so all of them send rate flows per second
+                interval = amount_of_tuples / float(rate)
+                if self.random.random() < periodic:
+                    kind = ('periodic', interval * self.random.uniform(0.5, 1.5), self.random.choice([200, 700, 2000]), self.random.choice([0.05, 1.0, 20.0]), self.random.choice([0.005, 0.02, 0.2]))
+                else:
+                    kind = ('random', interval)
+            dst_ip = '1.2.{}.{}'.format(self.random.randint(0, 255), self.random.randint(1, 250))
+            self.values.append((src_ip, dst_ip, self.random.choice(PORTS[protocol]), protocol, kind))
+            (time, size, duration) = self.get_flow(kind)
+            heapq.heappush(self.tuples, (self.random.random() * amount_of_tuples / float(rate), index, size, duration))
+
+    def choose(self, mix):
+        value = self.random.random() * sum([fraction for (protocol, fraction) in mix])
+        for (protocol, fraction) in mix:
+            value -= fraction
+            if value < 0:
+                return protocol
+        return mix[-1][0]
+
+    def get_flow(self, kind):
+        """ The time since the previous flow of the tuple, and the size and the duration of the next one """
+        if isinstance(kind, StateReplayer):
+            return kind.next_flow()
+        if kind[0] == 'periodic':
+            (name, period, size, duration, jitter) = kind
+            if self.random.random() > 0.9:
+                size = self.random.randint(1, 3000)
+            if self.random.random() > 0.9:
+                duration = self.random.random() * 20
+            if self.random.random() < 0.97:
+                return (period * self.random.uniform(1 - jitter, 1 + jitter), size, duration)
+            return (self.random.random() * 5 * period, size, duration)
+        return (self.random.expovariate(1 / kind[1]), self.random.randint(1, 3000), self.random.expovariate(1.0))
+
+    def generate(self, amount):
+        """ The lines of the next amount of flows """
+        for flow in xrange(amount):
+            (seconds, index, size, duration) = heapq.heappop(self.tuples)
+            (src_ip, dst_ip, port, protocol, kind) = self.values[index]
+            flowtime = STARTTIME + timedelta(seconds=round(seconds, 6))
+            yield '{},{:.6f},{},{},1,  ->,{},{},CON,0,0,4,{}\n'.format(flowtime.strftime('%Y/%m/%d %H:%M:%S.%f'), duration, protocol, src_ip, dst_ip, port, int(size))
+            (time, size, duration) = self.get_flow(kind)
+            heapq.heappush(self.tuples, (seconds + time, index, size, duration))
+
+    def write(self, output, amount):
+        for line in self.generate(amount):
+            output.write(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--flows', help='Amount of flows to generate.', action='store', default=100000, required=False, type=int)
+    parser.add_argument('-t', '--tuples', help='Amount of periodic and random tuples.', action='store', default=1000, required=False, type=int)
+    parser.add_argument('-r', '--rate', help='Flows per second of the periodic and random tuples together.', action='store', default=100.0, required=False, type=float)
+    parser.add_argument('-p', '--periodic', help='Fraction of the tuples that are periodic. The rest are random.', action='store', default=0.5, required=False, type=float)
+    parser.add_argument('-P', '--protocols', help='Fraction of the tuples of each protocol.', action='store', default='tcp=0.8,udp=0.2', required=False)
+    parser.add_argument('-m', '--models', help='Folder or bundle with the models whose states are replayed by the malicious tuples.', action='store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models'), required=False)
+    parser.add_argument('-M', '--malicious', help='Amount of malicious tuples.', action='store', default=0, required=False, type=int)
+    parser.add_argument('-s', '--seed', help='Seed of the random numbers.', action='store', default=1, required=False, type=int)
+    args = parser.parse_args()
+
+    states = get_model_states(args.models) if args.malicious else []
+    FlowGenerator(args.tuples, args.rate, args.periodic, parse_mix(args.protocols), states, args.malicious, args.seed).write(sys.stdout, args.flows)
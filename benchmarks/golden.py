@@ -0,0 +1,84 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Replay a captured binetflow file through the tuples of slips and compare their states with the expected ones. The
+# expected states of golden/capture.binetflow are in golden/capture.states, one tuple per line with its id and its
+# state separated by a tab. They were computed with the first version of slips, which parsed the times with strptime and
+# computed the periodicity with timedeltas. The capture has gaps of several hours, repeated start times and periods
+# near the thresholds. The whole states are compared, not only the window of the detection. The states that the batch
+# encoder of the offline analysis gives for all the flows of each tuple at once are compared too (with numpy).
+# Usage: ./benchmarks/golden.py [-f file] [-s states]
+
+import argparse
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slips import Tuple, LetterEncoder, TimeParser, numpy
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+
+def replay(file):
+    """ The states of the tuples of the flows of the file, computed as the Processor does """
+    encoder = LetterEncoder()
+    parser = TimeParser()
+    tuples = {}
+    with open(file) as input:
+        for line in input:
+            column_values = line.strip().split(',')
+            tuple4 = column_values[3]+'-'+column_values[6]+'-'+column_values[7]+'-'+column_values[2]
+            try:
+                tuple = tuples[tuple4]
+            except KeyError:
+                # All the letters are kept
+                tuple = Tuple(tuple4, encoder, sys.maxint)
+                tuple.set_verbose(0)
+                tuples[tuple4] = tuple
+            tuple.add_new_flow(column_values, parser.parse(column_values[0]))
+    return dict((tuple4, tuple.get_state()) for (tuple4, tuple) in tuples.iteritems())
+
+
+def get_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        # As the tuples do when the value is missing
+        return 0.0
+
+
+def encode(file):
+    """ The states of the tuples of the flows of the file, with all the flows of each tuple encoded at once """
+    encoder = LetterEncoder()
+    parser = TimeParser()
+    flows = {}
+    with open(file) as input:
+        for line in input:
+            column_values = line.strip().split(',')
+            tuple4 = column_values[3]+'-'+column_values[6]+'-'+column_values[7]+'-'+column_values[2]
+            flows.setdefault(tuple4, []).append((parser.parse(column_values[0]), get_float(column_values[1]), get_float(column_values[12])))
+    return dict((tuple4, encoder.encode_flows(*zip(*values))) for (tuple4, values) in flows.iteritems())
+
+
+def compare(name, expected, states):
+    """ Print the tuples whose states are not the expected ones """
+    different = sorted(tuple4 for tuple4 in set(expected) | set(states) if expected.get(tuple4) != states.get(tuple4))
+    for tuple4 in different[:5]:
+        print '{}\n\tExpected: {}\n\tState:    {}'.format(tuple4, expected.get(tuple4), states.get(tuple4))
+    print '{}: different states: {}'.format(name, len(different))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', help='Binetflow file to replay.', action='store', default=os.path.join(GOLDEN, 'capture.binetflow'), required=False)
+    parser.add_argument('-s', '--states', help='File with the expected states of its tuples.', action='store', default=os.path.join(GOLDEN, 'capture.states'), required=False)
+    args = parser.parse_args()
+
+    with open(args.states) as input:
+        expected = dict(line.rstrip('\n').split('\t') for line in input if line.strip())
+    print '{} tuples and {} letters expected.'.format(len(expected), sum(len(state) for state in expected.itervalues()))
+    compare('Flows added to the tuples', expected, replay(args.file))
+    if numpy:
+        compare('Flows of each tuple encoded at once', expected, encode(args.file))
+    else:
+        print 'The numpy library is not installed. The batch encoder is not checked.'
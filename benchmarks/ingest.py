@@ -0,0 +1,83 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Measure the ingest of the Processor: the CPU it uses while it waits for flows, and the lines per second it handles
+# when the lines are sent one by one or in batches.
+# Usage: ./benchmarks/ingest.py [-i seconds] [-l lines] [-q queue size] [-b batch sizes]
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing import Queue
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slips import Processor, LineBatcher
+
+
+def get_cpu_seconds(pid):
+    """ User and system CPU seconds used so far by the process. Linux only """
+    with open('/proc/{}/stat'.format(pid)) as stat:
+        values = stat.read().rsplit(')', 1)[1].split()
+    return (int(values[11]) + int(values[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def generate_lines(amount):
+    """ Flows in the format of ra.conf, for 100 tuples that send a flow each second """
+    starttime = datetime(2016, 1, 1)
+    lines = []
+    for index in xrange(amount):
+        flowtime = starttime + timedelta(seconds=index / 100, microseconds=index % 100)
+        lines.append('{},1.000000,tcp,10.0.0.1,{},   ->,10.0.1.{},80,CON,0,0,4,500\n'.format(flowtime.strftime('%Y/%m/%d %H:%M:%S.%f'), 1024 + index, index % 100))
+    return lines
+
+
+def start_processor(queue):
+    # Without detection and without printing, to measure only the ingest and the letters
+    processor = Processor(queue, timedelta(minutes=5), False, 0, -1, True)
+    processor.start()
+    return processor
+
+
+def measure_idle(seconds):
+    """ Percentage of one core used by the Processor while no flows arrive """
+    queue = Queue()
+    processor = start_processor(queue)
+    time.sleep(0.5)
+    before = get_cpu_seconds(processor.pid)
+    time.sleep(seconds)
+    after = get_cpu_seconds(processor.pid)
+    queue.put('stop')
+    processor.join()
+    return (after - before) * 100 / seconds
+
+
+def measure_throughput(lines, batch_size, queue_size):
+    """ Lines per second processed when they are sent in batches of this size, and the stats of the queue """
+    queue = Queue(queue_size)
+    processor = start_processor(queue)
+    start = time.time()
+    batcher = LineBatcher(queue, size=batch_size)
+    for line in lines:
+        batcher.put(line)
+    stats = batcher.get_stats()
+    batcher.close()
+    processor.join()
+    return (len(lines) / (time.time() - start), stats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--idle', help='Seconds to measure the CPU while idle.', action='store', default=5, required=False, type=float)
+    parser.add_argument('-l', '--lines', help='Amount of lines to send.', action='store', default=100000, required=False, type=int)
+    parser.add_argument('-q', '--queuesize', help='Max amount of batches waiting in the queue. 0 is unbounded.', action='store', default=1000, required=False, type=int)
+    parser.add_argument('-b', '--batches', help='Batch sizes to compare, separated by commas.', action='store', default='1,100,1000', required=False)
+    args = parser.parse_args()
+
+    print 'Idle CPU of the Processor: {:.1f}% of one core'.format(measure_idle(args.idle))
+    lines = generate_lines(args.lines)
+    for batch_size in [int(size) for size in args.batches.split(',')]:
+        (lines_per_second, stats) = measure_throughput(lines, batch_size, args.queuesize)
+        print 'Batches of {} lines: {:.0f} lines/sec. {}'.format(batch_size, lines_per_second, stats)
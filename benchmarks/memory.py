@@ -0,0 +1,62 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Measure the memory used by each tuple that slips keeps: the growth of the resident memory of the process while the
+# tuples are created, divided by the amount of tuples. Each tuple receives a few flows, as in a /16 network where most
+# tuples only see some connections. With -d each tuple is also detected after each flow, as the Processor does, so the
+# running scores of the models are included.
+# Usage: ./benchmarks/memory.py [-t tuples] [-f flows per tuple] [-d] [-m models]
+
+import argparse
+import gc
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slips import Tuple, LetterEncoder
+from modules.markov_models_1 import __markov_models__
+
+
+def get_rss():
+    """ Resident memory of this process in bytes. Linux only """
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def generate_flows(amount_of_tuples, flows_per_tuple):
+    """ The columns of the flows from 10.0.x.y to some servers, as the Processor splits them """
+    for flow in xrange(flows_per_tuple):
+        for index in xrange(amount_of_tuples):
+            yield ('2016/01/01 00:00:00.000000', '1.000000', 'tcp', '10.0.{}.{}'.format(index / 256 % 256, index % 256), '1024', '   ->', '8.8.{}.{}'.format(index % 7, index % 13), '443', 'CON', '0', '0', '4', '500'), 30.0 * flow
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--tuples', help='Amount of tuples to create.', action='store', default=200000, required=False, type=int)
+    parser.add_argument('-f', '--flows', help='Amount of flows of each tuple.', action='store', default=3, required=False, type=int)
+    parser.add_argument('-d', '--detect', help='Detect each tuple after each flow with the models.', action='store_true', default=False, required=False)
+    parser.add_argument('-m', '--models', help='Folder or bundle with the models used with -d.', action='store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models'), required=False)
+    args = parser.parse_args()
+
+    if args.detect:
+        __markov_models__.quiet = True
+        if not __markov_models__.set_models_folder(args.models):
+            sys.exit(-1)
+    encoder = LetterEncoder()
+    tuples = {}
+    gc.collect()
+    before = get_rss()
+    for (column_values, flowtime) in generate_flows(args.tuples, args.flows):
+        tuple4 = column_values[3]+'-'+column_values[6]+'-'+column_values[7]+'-'+column_values[2]
+        try:
+            tuple = tuples[tuple4]
+        except KeyError:
+            tuple = Tuple(tuple4, encoder)
+            tuple.set_verbose(0)
+            tuples[tuple4] = tuple
+        tuple.add_new_flow(column_values, flowtime)
+        if args.detect:
+            __markov_models__.detect(tuple, 0)
+    gc.collect()
+    used = get_rss() - before
+    print '{} tuples with {} flows each{}: {:.1f} MB, {:.0f} bytes per tuple'.format(len(tuples), args.flows, ' detected with {} models'.format(len(__markov_models__.models)) if args.detect else '', used / 1048576.0, used / float(len(tuples)))
@@ -0,0 +1,57 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Check the metrics file of -M with one processor and with several workers (-W): the same flows are counted, and only
+# one of each 8 flows is timed in the histograms of the parsing and the adding of the flows, as their help says, so the
+# histograms do not depend on how slips is run.
+# Usage: ./benchmarks/metrics.py [-l flows] [-t tuples] [-W workers]
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from generator import FlowGenerator
+
+SLIPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'slips.py')
+
+# One of each 8 values of these histograms is timed
+SAMPLED = ['parse_seconds', 'add_flow_seconds']
+
+
+def get_metrics(file, workers, folder):
+    """ The values of the metrics file written by slips for the flows of the file """
+    metrics = os.path.join(folder, 'slips.prom')
+    with open(file) as input, open(os.devnull, 'w') as output:
+        subprocess.check_call([sys.executable, SLIPS, '-D', '-v', '0', '-W', str(workers), '-M', metrics], stdin=input, stdout=output)
+    with open(metrics) as input:
+        return dict(re.findall(r'^slips_(\w+) (\S+)$', input.read(), re.M))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--flows', help='Amount of flows to generate.', action='store', default=30000, required=False, type=int)
+    parser.add_argument('-t', '--tuples', help='Amount of tuples of the generated flows.', action='store', default=1000, required=False, type=int)
+    parser.add_argument('-W', '--workers', help='Amount of workers to compare with one processor.', action='store', default=2, required=False, type=int)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        file = os.path.join(folder, 'flows.binetflow')
+        with open(file, 'w') as output:
+            FlowGenerator(args.tuples, args.tuples / 60.0).write(output, args.flows)
+        results = []
+        for workers in [1, args.workers]:
+            metrics = get_metrics(file, workers, folder)
+            flows = int(metrics['flows_total'])
+            sampled = [int(metrics[name + '_count']) for name in SAMPLED]
+            results.append(sampled)
+            # Each worker counts its own flows, so its last eighth may not be complete
+            print '{} workers: {} flows. Timed: {}. One of each 8: {}'.format(workers, flows, ', '.join('{} {}'.format(name, amount) for (name, amount) in zip(SAMPLED, sampled)),
+                                                                             all(abs(amount - flows / 8) <= workers for amount in sampled))
+        print 'Same timed flows with {} workers and with one processor: {}'.format(args.workers, all(abs(amount - base) <= args.workers for (amount, base) in zip(results[1], results[0])))
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,82 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Compare the offline analysis of a binetflow file (-R) with sending it to the standard input of slips: the flows per
+# second of each one, and whether their output is the same. The file is generated with periodic tuples and some that
+# replay the states of the models, unless one is given. Sending millions of flows to the standard input takes long, so only the
+# first lines of the file are sent, and the offline analysis of those lines is compared with it.
+# Usage: ./benchmarks/offline.py [-l flows] [-t tuples] [-s lines sent to the standard input] [-f file] [-m models]
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from generator import FlowGenerator, get_model_states
+
+SLIPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'slips.py')
+
+
+def run_slips(arguments, input=None):
+    """ The output of slips and the seconds it took """
+    start = time.time()
+    process = subprocess.Popen([sys.executable, SLIPS] + arguments, stdin=input, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    return (output, time.time() - start)
+
+
+def get_report(output):
+    """
+    The output without the lines about the ingest queue and the stats of the models. The main process of slips prints
+    the first ones while the processor prints, so they can be in the middle of its lines. The spaces are not compared.
+    """
+    output = output.replace('Finished receiving the input.\n', '')
+    output = re.sub(r'Ingest queue: [^\n]*\n', '', output)
+    output = re.sub(r'Models: [^\n]*\n', '', output)
+    return re.sub(r'\s+', '', output)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--flows', help='Amount of flows to generate.', action='store', default=2000000, required=False, type=int)
+    parser.add_argument('-t', '--tuples', help='Amount of tuples of the generated flows.', action='store', default=20000, required=False, type=int)
+    parser.add_argument('-s', '--stream', help='Amount of lines sent to the standard input of slips.', action='store', default=100000, required=False, type=int)
+    parser.add_argument('-f', '--file', help='Binetflow file to use instead of generating one.', action='store', required=False)
+    parser.add_argument('-m', '--models', help='Folder or bundle with the models.', action='store', default=os.path.join(os.path.dirname(SLIPS), 'models'), required=False)
+    args = parser.parse_args()
+
+    arguments = ['-f', args.models, '-a', '3']
+    file = args.file
+    if not file:
+        (handle, file) = tempfile.mkstemp(suffix='.binetflow')
+        with os.fdopen(handle, 'w') as output:
+            # Periodic tuples, with a flow every two minutes on average
+            FlowGenerator(args.tuples, args.tuples / 120.0, 1.0, [('tcp', 0.75), ('udp', 0.25)], get_model_states(args.models), 32).write(output, args.flows)
+    try:
+        with open(file) as input:
+            amount = sum(1 for line in input)
+        (output, seconds) = run_slips(arguments + ['-R', file])
+        print 'Offline: {} flows in {:.1f} seconds. {:.0f} flows/sec. {} detections.'.format(amount, seconds, amount / seconds, output.count('Detected as:'))
+
+        # The first lines, to the standard input and offline
+        (handle, prefix) = tempfile.mkstemp(suffix='.binetflow')
+        with os.fdopen(handle, 'w') as output, open(file) as input:
+            for (index, line) in enumerate(input):
+                if index == args.stream:
+                    break
+                output.write(line)
+        try:
+            with open(prefix) as input:
+                (streamed, stream_seconds) = run_slips(arguments, input)
+            (offline, offline_seconds) = run_slips(arguments + ['-R', prefix])
+        finally:
+            os.remove(prefix)
+        lines = min(amount, args.stream)
+        print 'Standard input: {} flows in {:.1f} seconds. {:.0f} flows/sec.'.format(lines, stream_seconds, lines / stream_seconds)
+        print 'Offline on the same flows: {:.1f} seconds. {:.1f} times faster. Same output: {}'.format(offline_seconds, stream_seconds / offline_seconds, get_report(streamed) == get_report(offline))
+    finally:
+        if not args.file:
+            os.remove(file)
@@ -0,0 +1,57 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Check the periodic patterns of -P: a pattern of our own changes the verdict of a tuple that has none of the basic
+# patterns, and the search that only reads the new letters of each tuple gives the same verdict as looking for each
+# pattern in the whole window, while random letters are added and leave the window.
+# Usage: ./benchmarks/periodic.py [-t tuples] [-w window]
+
+import argparse
+import os
+import random
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from modules.markov_models_1 import MarkovModelsDetection, BASIC_PERIODIC_PATTERNS
+from slips import Tuple, LetterEncoder
+
+# Not periodic for the basic patterns, which need a strongly or weakly periodic letter
+PATTERNS = ['r.r.r.', 'R*S*R*S*', '0a,']
+
+
+def compare(detection, patterns, amount, window):
+    """ Add random letters to tuples and compare each verdict with the search of each pattern. Return the verdicts and the differences """
+    generator = random.Random(0)
+    # Few letters, so the patterns are found often. The zeros of the long gaps go alone
+    letters = ['0'] + [letter + symbol for letter in 'arRS' for symbol in '.,*']
+    encoder = LetterEncoder()
+    periodic = different = 0
+    for index in xrange(amount):
+        tuple = Tuple('10.0.0.1-10.0.0.{}-53-udp'.format(index), encoder, window)
+        for flow in xrange(generator.randint(1, 4 * window)):
+            tuple.add_letters(generator.choice(letters))
+            found = detection.is_tuple_periodic(tuple)
+            periodic += found
+            different += found != any(pattern in tuple.get_state() for pattern in patterns)
+    return (periodic, different)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--tuples', help='Amount of tuples with random letters.', action='store', default=300, required=False, type=int)
+    parser.add_argument('-w', '--window', help='Letters of the window of each tuple.', action='store', default=20, required=False, type=int)
+    args = parser.parse_args()
+
+    detection = MarkovModelsDetection()
+    encoder = LetterEncoder()
+    tuple = Tuple('10.0.0.1-10.0.0.2-53-udp', encoder, args.window)
+    tuple.add_letters('r.r.r.r.s.s.')
+    print 'The state {} is periodic with the basic patterns: {}'.format(tuple.get_state(), detection.is_tuple_periodic(tuple))
+    # The patterns can change while the tuple is kept
+    detection.set_periodic_patterns(PATTERNS)
+    print 'With the patterns {}: {}'.format(', '.join(PATTERNS), detection.is_tuple_periodic(tuple))
+
+    for (name, patterns) in [('basic', []), ('own', PATTERNS)]:
+        detection.set_periodic_patterns(patterns)
+        (periodic, different) = compare(detection, BASIC_PERIODIC_PATTERNS + patterns, args.tuples, args.window)
+        print 'Random tuples with the {} patterns: {} periodic verdicts. Different from searching each pattern: {}'.format(name, periodic, different)
@@ -0,0 +1,87 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Check the WhoisResolver of -d with a slow fake lookup instead of the whois servers, so ipwhois is not needed: the
+# IPs asked never wait for the lookup, each IP is looked up once while it is pending, the answers are stored in the
+# cache that other resolvers share, and the answers used recently are kept in memory while the rest are forgotten.
+# Usage: ./benchmarks/resolver.py [-i ips] [-d seconds of each lookup]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import modules.whois as whois
+
+
+class StubLookup(object):
+    """ A lookup that takes some time and remembers the IPs asked """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.ips = []
+        self.lock = threading.Lock()
+
+    def __call__(self, ip):
+        with self.lock:
+            self.ips.append(ip)
+        time.sleep(self.seconds)
+        return self.get_answer(ip)
+
+    def get_answer(self, ip):
+        return 'Stub network of {},CZ'.format(ip)
+
+
+def wait_answers(resolver, ips, timeout=60):
+    """ Ask the IPs until all are answered. Return the seconds waited and the answers """
+    start = time.time()
+    while time.time() - start < timeout:
+        answers = [resolver.get_whois(ip) for ip in ips]
+        if whois.PENDING not in answers:
+            break
+        time.sleep(0.01)
+    return (time.time() - start, answers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--ips', help='Amount of IPs to ask.', action='store', default=200, required=False, type=int)
+    parser.add_argument('-d', '--delay', help='Seconds of each lookup.', action='store', default=0.05, required=False, type=float)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        file = os.path.join(folder, 'whois.db')
+        ips = ['10.{}.{}.{}'.format(index / 65536 % 256, index / 256 % 256, index % 256) for index in xrange(args.ips)]
+
+        # The IPs are asked several times while they are pending, as the tuples of the same destination do
+        lookup = StubLookup(args.delay)
+        resolver = whois.WhoisResolver(whois.WhoisCache(file), lookup=lookup)
+        slowest = 0
+        answers = []
+        for ip in ips * 3:
+            start = time.time()
+            answers.append(resolver.get_whois(ip))
+            slowest = max(slowest, time.time() - start)
+        print 'Asked {} IPs 3 times: {} pending, the slowest answer took {:.2f} ms.'.format(len(ips), answers.count(whois.PENDING), slowest * 1000)
+        (seconds, answers) = wait_answers(resolver, ips)
+        print 'Answered after {:.1f} seconds. Right answers: {}. Lookups: {}.'.format(seconds, answers == [lookup.get_answer(ip) for ip in ips], len(lookup.ips))
+
+        # Another resolver, as in another process or the next run, finds them in the cache
+        other = StubLookup(args.delay)
+        (seconds, answers) = wait_answers(whois.WhoisResolver(whois.WhoisCache(file), lookup=other), ips)
+        print 'Another resolver with the same cache: answered after {:.1f} seconds. Lookups: {}.'.format(seconds, len(other.ips))
+
+        # Only a few answers in memory. The one used after each new answer is never forgotten, so it is never pending again
+        resolver = whois.WhoisResolver(whois.WhoisCache(file), lookup=StubLookup(args.delay), max_results=10)
+        wait_answers(resolver, ips[:1])
+        pending = 0
+        for ip in ips[1:]:
+            wait_answers(resolver, [ip])
+            pending += resolver.get_whois(ips[0]) == whois.PENDING
+        print 'Answers kept in memory: {} of {}. The one used all the time was pending {} times.'.format(len(resolver.results), len(ips), pending)
+    finally:
+        shutil.rmtree(folder)
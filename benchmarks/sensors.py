@@ -0,0 +1,98 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Check the reading of several sensors at the same time (-i). The same flows are sent by three fake sensors: a TCP
+# server, a FIFO and a command. The report should be the one of the flows sent to the standard input, with each tuple
+# once for each sensor. The sensors are read at different speeds, so the flows are reordered with -O. The last slot is
+# not compared, because slips adds the last flow again to its tuple, and it is only in one of the sensors.
+# Usage: ./benchmarks/sensors.py [-l flows] [-f file] [-m models]
+
+import argparse
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+from generator import FlowGenerator, get_model_states
+from offline import run_slips, SLIPS
+
+SENSORS = ['socket', 'fifo', 'command']
+HEADER = re.compile(r'Slot Started: (.*)\. \((\d+) connections\)')
+
+
+def serve(file):
+    """ A TCP server that sends the lines of the file to its first client. Return its port """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def send():
+        (client, address) = server.accept()
+        with open(file) as input:
+            client.sendall(input.read())
+        client.close()
+        server.close()
+    sender = threading.Thread(target=send)
+    sender.daemon = True
+    sender.start()
+    return server.getsockname()[1]
+
+
+def write_fifo(fifo, file):
+    """ Write the lines of the file in a new FIFO, when slips opens it """
+    os.mkfifo(fifo)
+
+    def write():
+        with open(fifo, 'w') as output, open(file) as input:
+            output.write(input.read())
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+
+
+def get_slots(output, sensors=[]):
+    """ The time, the amount of connections and the sorted lines of each slot, without the ids of the sensors """
+    output = re.sub(r'(Finished receiving [^\n]*|Ingest queue: [^\n]*)\n', '', output)
+    for sensor in sensors:
+        output = output.replace('-{}\x1b'.format(sensor), '\x1b')
+    slots = []
+    for part in output.split('\x1b[36m')[1:]:
+        lines = part.splitlines()
+        (times, amount) = HEADER.search(lines[0]).groups()
+        slots.append((times, int(amount), sorted([line for line in lines[1:] if line.strip()])))
+    return slots
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--flows', help='Amount of flows to generate.', action='store', default=20000, required=False, type=int)
+    parser.add_argument('-f', '--file', help='Binetflow file to use instead of generating one.', action='store', required=False)
+    parser.add_argument('-m', '--models', help='Folder or bundle with the models.', action='store', default=os.path.join(os.path.dirname(SLIPS), 'models'), required=False)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        file = args.file
+        if not file:
+            file = os.path.join(folder, 'flows.binetflow')
+            with open(file, 'w') as output:
+                FlowGenerator(1000, 100.0, 0.5, [('tcp', 0.8), ('udp', 0.2)], get_model_states(args.models), 16).write(output, args.flows)
+        arguments = ['-f', args.models, '-w', '1']
+        with open(file) as input:
+            (single, single_seconds) = run_slips(arguments, input)
+
+        fifo = os.path.join(folder, 'sensor.fifo')
+        write_fifo(fifo, file)
+        sources = ['socket=tcp:127.0.0.1:{}'.format(serve(file)), 'fifo={}'.format(fifo), 'command=cmd:cat {}'.format(file)]
+        (multiple, multiple_seconds) = run_slips(arguments + ['-O', '600', '-i'] + sources)
+        print 'Standard input: {:.1f} seconds. Three sensors: {:.1f} seconds.'.format(single_seconds, multiple_seconds)
+
+        single_slots = get_slots(single)
+        multiple_slots = get_slots(multiple, SENSORS)
+        expected = [(times, amount * len(SENSORS), sorted(lines * len(SENSORS))) for (times, amount, lines) in single_slots]
+        print 'Slots: {} and {}. Detections: {} and {}.'.format(len(single_slots), len(multiple_slots), single.count('Detected as:'), multiple.count('Detected as:'))
+        print 'Same output: {}'.format(len(expected) == len(multiple_slots) and expected[:-1] == multiple_slots[:-1])
+    finally:
+        shutil.rmtree(folder)
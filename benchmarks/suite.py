@@ -0,0 +1,173 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Run the Processor and the detection of slips on a fixed set of generated workloads, and save the results in a JSON
+# file so the runs can be compared over time. For each workload: flows per second, the median and 99th percentile time
+# to process each flow, the peak resident memory, and the detections of the malicious tuples (which replay the states
+# of the models) and of the rest. Each workload runs in its own process, so its memory is measured alone.
+# Usage: ./benchmarks/suite.py [-s workloads] [-l flows] [-m models] [-b] [-o results.json] [-c previous.json]
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from datetime import datetime
+from datetime import timedelta
+from multiprocessing import Process, Queue
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slips import Processor, version
+from modules.markov_models_1 import __markov_models__
+from generator import FlowGenerator, get_model_states, parse_mix, MALICIOUS_NETWORK
+
+# The workloads. Always generated with the same seed
+WORKLOADS = [
+    {'name': 'mixed', 'flows': 100000, 'tuples': 2000, 'rate': 200.0, 'periodic': 0.5, 'protocols': 'tcp=0.8,udp=0.2', 'malicious': 32},
+    {'name': 'periodic', 'flows': 100000, 'tuples': 2000, 'rate': 200.0, 'periodic': 1.0, 'protocols': 'tcp=1.0', 'malicious': 32},
+    {'name': 'random', 'flows': 100000, 'tuples': 2000, 'rate': 200.0, 'periodic': 0.0, 'protocols': 'tcp=0.5,udp=0.5', 'malicious': 0},
+    {'name': 'many-tuples', 'flows': 100000, 'tuples': 50000, 'rate': 1000.0, 'periodic': 0.5, 'protocols': 'tcp=0.8,udp=0.2', 'malicious': 32},
+]
+
+
+class FileQueue(object):
+    """ The lines of a file in batches, as the LineBatcher sends them to the Processor, and then the stop """
+    def __init__(self, file, size=100):
+        self.file = file
+        self.size = size
+
+    def get(self, block=True, timeout=None):
+        return list(itertools.islice(self.file, self.size)) or 'stop'
+
+    def qsize(self):
+        return 0
+
+
+class BenchmarkProcessor(Processor):
+    """ A Processor that keeps the time to process each flow, and the tuples detected with their label """
+    def __init__(self, queue):
+        Processor.__init__(self, queue, timedelta(minutes=5), False, 0, -1, False)
+        self.latencies = array('d')
+        self.detections = 0
+        self.detected = {}
+
+    def process_flow(self, column_values, flowtime):
+        start = time.time()
+        Processor.process_flow(self, column_values, flowtime)
+        self.latencies.append(time.time() - start)
+
+    def set_detection(self, tuple, detected, label):
+        if detected:
+            self.detections += 1
+            self.detected[tuple.get_id()] = label
+        Processor.set_detection(self, tuple, detected, label)
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+def run_workload(file, malicious, results):
+    """ Process the flows of the file and send the results. Runs in its own process """
+    processor = BenchmarkProcessor(None)
+    with open(file) as input:
+        processor.queue = FileQueue(input)
+        start = time.time()
+        processor.run()
+        seconds = time.time() - start
+    latencies = sorted(processor.latencies)
+    flows = processor.metrics.get('flows')
+    # The malicious tuples detected with the label of the model they replay, and the other tuples detected
+    found = dict((tuple4.split('-')[0], label) for (tuple4, label) in processor.detected.iteritems())
+    metrics = processor.get_metrics()
+    results.put({
+        'flows': flows,
+        'seconds': round(seconds, 3),
+        'flows_per_second': round(flows / seconds, 1),
+        'latency_p50_ms': round(get_percentile(latencies, 0.5) * 1000, 4),
+        'latency_p99_ms': round(get_percentile(latencies, 0.99) * 1000, 4),
+        'slot_flush_p99_ms': metrics.get_histogram('slot_flush_seconds').get_quantile(0.99) * 1000,
+        # In KB in Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        'tuples': len(processor.tuples),
+        'detections': processor.detections,
+        'detected_tuples': len(processor.detected),
+        'malicious_tuples': len(malicious),
+        'malicious_detected': len([ip for ip in malicious if ip in found]),
+        'malicious_detected_as_replayed': len([ip for ip in malicious if found.get(ip) == malicious[ip]]),
+        'other_detected': len([ip for ip in found if not ip.startswith(MALICIOUS_NETWORK + '.')]),
+    })
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--workloads', help='Workloads to run, separated by commas. All by default: {}.'.format(', '.join([workload['name'] for workload in WORKLOADS])), action='store', required=False)
+    parser.add_argument('-l', '--flows', help='Amount of flows of each workload, instead of its own.', action='store', required=False, type=int)
+    parser.add_argument('-m', '--models', help='Folder or bundle with the models.', action='store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models'), required=False)
+    parser.add_argument('-b', '--batch', help='Score the models in batches with numpy, as slips -b.', action='store_true', default=False, required=False)
+    parser.add_argument('-o', '--output', help='JSON file where the results are saved.', action='store', default='benchmark.json', required=False)
+    parser.add_argument('-c', '--compare', help='JSON file of a previous run to compare with.', action='store', required=False)
+    args = parser.parse_args()
+
+    workloads = WORKLOADS
+    if args.workloads:
+        names = args.workloads.split(',')
+        workloads = [workload for workload in WORKLOADS if workload['name'] in names]
+    # The models are read once, and each process gets them
+    states = get_model_states(args.models)
+    if not states:
+        sys.exit(-1)
+    __markov_models__.set_batch(args.batch)
+
+    results = {'version': version, 'commit': get_commit(), 'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+               'models': len(__markov_models__.models), 'batch': args.batch, 'workloads': []}
+    for workload in workloads:
+        workload = dict(workload)
+        if args.flows:
+            workload['flows'] = args.flows
+        generator = FlowGenerator(workload['tuples'], workload['rate'], workload['periodic'], parse_mix(workload['protocols']), states, workload['malicious'])
+        # The source IP of each malicious tuple, with the label of the model it replays
+        malicious = dict((values[0], states[index % len(states)][0]) for (index, values) in enumerate(generator.values[:workload['malicious']]))
+        (handle, file) = tempfile.mkstemp(suffix='.binetflow')
+        try:
+            with os.fdopen(handle, 'w') as output:
+                generator.write(output, workload['flows'])
+            queue = Queue()
+            process = Process(target=run_workload, args=(file, malicious, queue))
+            process.start()
+            workload.update(queue.get())
+            process.join()
+        finally:
+            os.remove(file)
+        results['workloads'].append(workload)
+        print '{name}: {flows_per_second:.0f} flows/sec. Per flow p50 {latency_p50_ms:.3f} ms, p99 {latency_p99_ms:.3f} ms. Peak RSS {peak_rss_mb} MB. {malicious_detected} of {malicious_tuples} malicious tuples detected ({malicious_detected_as_replayed} with their model), {other_detected} other tuples detected.'.format(**workload)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print 'Results saved in {}'.format(args.output)
+
+    if args.compare:
+        with open(args.compare) as input:
+            previous = dict((workload['name'], workload) for workload in json.load(input)['workloads'])
+        print 'Compared with {}:'.format(args.compare)
+        for workload in results['workloads']:
+            before = previous.get(workload['name'])
+            if not before:
+                continue
+            print '\t{}: flows/sec x{:.2f}, p99 x{:.2f}, peak RSS x{:.2f}, detections {} -> {}'.format(
+                workload['name'], workload['flows_per_second'] / before['flows_per_second'], workload['latency_p99_ms'] / max(before['latency_p99_ms'], 0.0001),
+                workload['peak_rss_mb'] / before['peak_rss_mb'], before['detections'], workload['detections'])
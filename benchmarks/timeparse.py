@@ -0,0 +1,52 @@
+#!/usr/bin/python -u
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+# Compare the parse of the starttime of the flows with strptime and with the TimeParser of slips, and check that both
+# give the same seconds.
+# Usage: ./benchmarks/timeparse.py [-l lines]
+
+import argparse
+import calendar
+import os
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from slips import TimeParser
+
+
+def generate_times(amount):
+    """ Starttimes in the format of ra.conf, 100 flows each second """
+    starttime = datetime(2016, 1, 1, 23, 50)
+    return [(starttime + timedelta(seconds=index / 100, microseconds=index * 7919 % 1000000)).strftime('%Y/%m/%d %H:%M:%S.%f') for index in xrange(amount)]
+
+
+def parse_strptime(times):
+    result = []
+    for text in times:
+        flowtime = datetime.strptime(text, '%Y/%m/%d %H:%M:%S.%f')
+        result.append(calendar.timegm(flowtime.timetuple()) + flowtime.microsecond / 1e6)
+    return result
+
+
+def parse_timeparser(times):
+    parser = TimeParser()
+    return [parser.parse(text) for text in times]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--lines', help='Amount of times to parse.', action='store', default=200000, required=False, type=int)
+    args = parser.parse_args()
+
+    times = generate_times(args.lines)
+    results = []
+    for (name, function) in [('strptime', parse_strptime), ('TimeParser', parse_timeparser)]:
+        start = time.time()
+        results.append(function(times))
+        print '{}: {:.0f} times/sec'.format(name, len(times) / (time.time() - start))
+    # Both must give the same microseconds
+    differences = sum(1 for (first, second) in zip(results[0], results[1]) if round(first, 6) != round(second, 6))
+    print 'Different times: {}'.format(differences)
@@ -4,9 +4,53 @@
 from colors import *
 import cPickle
 import math
+import operator
+from collections import deque
+from bisect import bisect_left, bisect_right
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
 from os import listdir
 from os.path import isfile, join
 import stf.common.markov_chains as mc
+try:
+    import numpy
+except ImportError:
+    # Only needed to score the models in batches
+    numpy = False
+
+# Log probability assigned to the transitions that are not in the matrix. Which is approx 0.01 probability
+PENALTY = -4.6
+# The running probs are added as integers in units of 2**-40. Each log prob is rounded once, so the sums are exact, they
+# do not drift while letters come and go, and two states with the same transitions always get exactly the same prob.
+# The scores of the tuples are stored in arrays of machine integers, where the sums of hundreds of thousands of
+# transitions fit with 64 bits. A sum that does not fit is not kept, and it is computed again with the next letters.
+FIXED_POINT = 1 << 40
+MAX_FIXED = (1 << (8 * array('l').itemsize - 1)) - 1
+
+# The bundles of models start with this header: magic, version and length of the index
+BUNDLE_HEADER = '<8sII'
+BUNDLE_MAGIC = 'SLIPSMB\0'
+BUNDLE_VERSION = 1
+
+# Values stored in the scores of a tuple for each model
+MODEL_SCORES = 4
+
+# The time of the scoring of each model is measured in one of each this amount of detections
+MODEL_TIMES_SAMPLE = 16
+
+
+def to_fixed(value):
+    return int(round(value * FIXED_POINT))
+
+
+def from_fixed(value):
+    return operator.truediv(value, FIXED_POINT)
+
+PENALTY_FIXED = to_fixed(PENALTY)
 
 
 class Model():
@@ -16,6 +60,7 @@ class Model():
         self.matrix = False
         self.self_probability = -1
         self.label = -1
+        self.compiled = False
         # To store when did this model had the best match. Later use to cut the state
         self.best_matching_len = -1
 
@@ -42,7 +87,7 @@ class Model():
         """ Given a chain of letters, return the probability that it was generated by this MC """
         i = 0
         probability = 0
-        penalty = -4.6  # Which is approx 0.01 probability
+        penalty = PENALTY
         # Get the initial probability of this letter in the IV.
         try:
             init_letter_prob = math.log(self.init_vector[state[i]])
@@ -79,6 +124,142 @@ class Model():
                 break
         return probability
 
+    def compile(self):
+        """
+        Compile the matrix of the whole training state, which is the one used when the tuple state is at least as long as it.
+        The matrix is created from the state, as it was always done for the detection, and not taken from the file.
+        """
+        (init_vector, matrix) = mc.maximum_likelihood_probabilities(list(self.state), order=1)
+        try:
+            self.set_compiled(mc.CompiledMatrix(init_vector, matrix, PENALTY))
+        except ValueError as e:
+            print '\tThe model {} can not be compiled: {}'.format(self.id, e)
+            self.compiled = False
+            return False
+        return True
+
+    def set_compiled(self, compiled):
+        self.compiled = compiled
+        # The same probs for the running scores of the tuples. Most of them are the penalty, so each value is converted once
+        fixed = dict((prob, to_fixed(prob)) for prob in set(compiled.transitions))
+        self.compiled_transitions = [fixed[prob] for prob in compiled.transitions]
+
+    def compute_compiled_probability(self, state):
+        """ Given a chain of letters, return the probability that it was generated by the compiled matrix of the whole training state """
+        return self.compiled.compute_probability(mc.encode(state))
+
+    def index_prefixes(self):
+        """
+        Precompute what is needed to score against the matrix of any prefix of the training state.
+        Instead of creating the matrix again for each prefix, store where each transition happens in the state, so the
+        amount of times it happens in any prefix is a bisect.
+        """
+        # (letter, next letter) -> positions of that transition in the state. Sorted because we walk the state in order
+        pair_positions = {}
+        # letter -> positions where the letter starts a transition
+        source_positions = {}
+        for index in xrange(len(self.state) - 1):
+            pair = (self.state[index], self.state[index + 1])
+            pair_positions.setdefault(pair, []).append(index)
+            source_positions.setdefault(pair[0], []).append(index)
+        self.set_prefix_index(pair_positions, source_positions)
+
+    def set_prefix_index(self, pair_positions, source_positions):
+        """ Use these sorted positions of each transition and of each letter that starts one. Any sequence works with bisect """
+        self.pair_positions = pair_positions
+        self.source_positions = source_positions
+        # The probs of the prefixes of 0 and 1 letters are the values that compute_probability() gives for them.
+        # The rest are computed when a tuple needs them, and then shared by all the tuples.
+        self.training_probabilities = [PENALTY, 0]
+        # Transitions of the longest prefix computed so far. letter -> {next letter: amount}
+        self.training_rows = {}
+        # The fixed point prob of each row of the longest prefix, and of all of them
+        self.training_rows_probability = {}
+        self.training_probability = 0
+
+    def get_training_probability(self, statelen):
+        """ Probability of the first statelen letters of the training state, computed with the matrix of those letters """
+        while len(self.training_probabilities) <= statelen:
+            # Add the next transition to the prefix. Only the probs of the row of its first letter change
+            prefixlen = len(self.training_probabilities)
+            letter1 = self.state[prefixlen - 2]
+            row = self.training_rows.setdefault(letter1, {})
+            row[self.state[prefixlen - 1]] = row.get(self.state[prefixlen - 1], 0) + 1
+            row_probability = 0
+            for letter2, amount in row.iteritems():
+                row_probability += amount * self.transition_probability(letter1, letter2, prefixlen)
+            self.training_probability += row_probability - self.training_rows_probability.get(letter1, 0)
+            self.training_rows_probability[letter1] = row_probability
+            self.training_probabilities.append(from_fixed(to_fixed(self.init_probability(self.state[0], prefixlen)) + self.training_probability))
+        return self.training_probabilities[statelen]
+
+    def init_probability(self, letter, statelen):
+        """ Log prob of the letter in the init vector of the first statelen letters of the training state """
+        # The first statelen letters have statelen - 1 transitions
+        amount = bisect_left(self.source_positions.get(letter, ()), statelen - 1)
+        if not amount:
+            # Not in the init vector, which does not influence the prob
+            return 0
+        return math.log(amount / float(statelen - 1))
+
+    def transition_probability(self, letter1, letter2, statelen):
+        """ Fixed point log prob of the transition in the matrix of the first statelen letters of the training state """
+        if statelen >= len(self.state) and self.compiled:
+            return self.compiled_transitions[mc.SYMBOLS.get(letter1, mc.OTHER) * mc.SIZE + mc.SYMBOLS.get(letter2, mc.OTHER)]
+        amount = bisect_left(self.pair_positions.get((letter1, letter2), ()), statelen - 1)
+        if not amount:
+            return PENALTY_FIXED
+        return to_fixed(math.log(amount / float(bisect_left(self.source_positions[letter1], statelen - 1))))
+
+    def update_scores(self, scores, position, old_transitions, new_transitions, letters, limit=False):
+        """
+        Update the running prob of the tuple with the transitions that left its window and the new ones, and return the
+        training prefix length, the prob of the tuple state, which has now this amount of letters, and the amount of
+        transitions not scored.
+        The position is the one of the model in the list of the detection, where its scores are stored in the tuple.
+        The scores already do not have the old transitions, and still do not have the new ones.
+        If the prob is computed from scratch and a limit is given, it stops as soon as the distance can not be below
+        the limit, as detect_state() does. Then the prob is False, and nothing is kept for the next time.
+        """
+        # The tuple is compared with the same amount of letters of the training state
+        statelen = min(letters, len(self.state))
+        (model_id, prefixlen, probability, scored_letters) = scores.get_model(position)
+        if model_id == self.id and scored_letters == scores.letters and prefixlen <= statelen:
+            # The old transitions were added with the previous prefix
+            for (letter1, letter2) in old_transitions:
+                probability -= self.transition_probability(letter1, letter2, prefixlen)
+            # Move the training prefix forward. Each new training transition only changes the row of its first letter
+            for index in xrange(prefixlen - 1, statelen - 1):
+                letter1 = self.state[index]
+                row = scores.transitions.get(letter1)
+                if row:
+                    for letter2, amount in row.iteritems():
+                        probability += amount * (self.transition_probability(letter1, letter2, index + 2) - self.transition_probability(letter1, letter2, index + 1))
+        else:
+            # First time for this tuple with this model, the scores were computed for another state, or another model
+            # was in this position before the models were reloaded. Compute them from scratch
+            probability = 0
+            if limit is not False:
+                init = to_fixed(self.init_probability(scores.first_letter, statelen))
+                training = self.get_training_probability(statelen)
+            rows = scores.transitions.iteritems()
+            for letter1, row in rows:
+                if limit is not False and training < 0 and from_fixed(init + probability) / training > limit:
+                    # The test prob can only go down, so the distance can only grow. Checked once per row
+                    scores.set_model(position, 0, 0, 0, 0)
+                    skipped = sum(row.itervalues()) + sum(sum(rest.itervalues()) for (letter, rest) in rows) + len(new_transitions)
+                    return (statelen, False, skipped)
+                for letter2, amount in row.iteritems():
+                    probability += amount * self.transition_probability(letter1, letter2, statelen)
+        for (letter1, letter2) in new_transitions:
+            probability += self.transition_probability(letter1, letter2, statelen)
+        if -MAX_FIXED <= probability <= MAX_FIXED:
+            scores.set_model(position, self.id, statelen, probability, scores.next_letters)
+        else:
+            # Too many transitions for the array. Computed from scratch the next time, which is exact
+            scores.set_model(position, 0, 0, 0, 0)
+        return (statelen, from_fixed(to_fixed(self.init_probability(scores.first_letter, statelen)) + probability), 0)
+
     def set_state(self, state):
         self.state = state
 
@@ -131,6 +312,233 @@ class Model():
     def get_threshold(self):
         return self.threshold
 
+    def get_fingerprint(self):
+        """ What the detection uses from the model file. Two models with the same fingerprint detect the same """
+        return (self.label, self.threshold, self.state)
+
+
+# The same strongly or weakly periodic letter three times in a row, with the same symbol: a,a,a, B+B+B+ ...
+BASIC_PERIODIC_PATTERNS = [(letter + symbol) * 3 for letters in ['abcdefghi', 'ABCDEFGHI'] for symbol in ',+*' for letter in letters]
+
+
+class PatternMatcher():
+    """
+    Aho-Corasick automaton to find several patterns in a state at once. Each letter moves the automaton one step, so the
+    time does not depend on the amount of patterns, and the search can go on when new letters arrive.
+    """
+    def __init__(self, patterns):
+        # The transitions of each node, by letter. The letters without transition go to the root
+        self.next = [{}]
+        # The length of the shortest pattern that ends in each node. 0 if none
+        self.shortest = [0]
+        for pattern in patterns:
+            node = 0
+            for letter in pattern:
+                if letter not in self.next[node]:
+                    self.next.append({})
+                    self.shortest.append(0)
+                    self.next[node][letter] = len(self.next) - 1
+                node = self.next[node][letter]
+            if pattern and (not self.shortest[node] or len(pattern) < self.shortest[node]):
+                self.shortest[node] = len(pattern)
+        # Follow the failure links in breadth first order, and add their transitions to each node. Then the automaton
+        # never needs to follow them while searching
+        alphabet = set(letter for pattern in patterns for letter in pattern)
+        fail = [0] * len(self.next)
+        queue = deque(self.next[0].values())
+        while queue:
+            node = queue.popleft()
+            link = fail[node]
+            if self.shortest[link] and (not self.shortest[node] or self.shortest[link] < self.shortest[node]):
+                self.shortest[node] = self.shortest[link]
+            for letter in alphabet:
+                if letter in self.next[node]:
+                    child = self.next[node][letter]
+                    fail[child] = self.next[link].get(letter, 0)
+                    queue.append(child)
+                elif letter in self.next[link]:
+                    self.next[node][letter] = self.next[link][letter]
+
+    def search(self, letters, node=0, position=0):
+        """
+        Read the letters starting in this node. The position is the one of the first letter in the state. Return the
+        node after the letters and the last position where a pattern found starts, or -1
+        """
+        next = self.next
+        shortest = self.shortest
+        match = -1
+        for letter in letters:
+            node = next[node].get(letter, 0)
+            position += 1
+            if shortest[node] and position - shortest[node] > match:
+                match = position - shortest[node]
+        return (node, match)
+
+
+class TupleScores(object):
+    """
+    The running probabilities of the state of one tuple against each model. They live in the tuple, so they are forgotten together with it.
+    """
+    __slots__ = ['letters', 'start', 'next_letters', 'next_start', 'transitions', 'models', 'first_letter', 'batch', 'batch_probabilities',
+                 'batch_covered', 'batch_letters', 'periodic_matcher', 'periodic_node', 'periodic_letters', 'periodic_match']
+
+    def __init__(self):
+        # The positions after the last letter and of the first letter of the window of the state already scored. The
+        # positions count all the letters of the tuple, also the ones that already left the window
+        self.letters = 0
+        self.start = 0
+        # The same for the window being scored now
+        self.next_letters = 0
+        self.next_start = 0
+        # The transitions of the state. letter -> {next letter: amount}
+        self.transitions = {}
+        # MODEL_SCORES values for each position of a model in the detection: its id, the length of the training prefix
+        # used, the fixed point log prob of the transitions and the letters scored
+        self.models = array('l')
+        self.first_letter = ''
+        # The batch of models used for the tuple, the log probs of the transitions against each of its models,
+        # how many of them were covered and the letters scored
+        self.batch = False
+        self.batch_probabilities = False
+        self.batch_covered = 0
+        self.batch_letters = 0
+        # The matcher of the periodic patterns, its node after the letters read, the position after the last letter
+        # read and the position where the last pattern found starts
+        self.periodic_matcher = False
+        self.periodic_node = 0
+        self.periodic_letters = 0
+        self.periodic_match = -1
+
+    def get_changes(self, tuple, state):
+        """
+        Return the transitions that left the window of the tuple state and the ones of the letters added since the last
+        time. The old ones are removed from the transitions now, the new ones are added after all the models used them.
+        """
+        start = tuple.get_state_start()
+        end = start + len(state)
+        old_transitions = []
+        if self.letters and start > self.start:
+            # The transitions from the letters that left, including the one to the first letter of the window if it was scored
+            old = tuple.get_letters(self.start, min(start + 1, self.letters))
+            if old is False or end < self.letters:
+                # The letters are not known anymore. Start again with the whole window
+                self.__init__()
+            else:
+                old_transitions = zip(old, old[1:])
+                for (letter1, letter2) in old_transitions:
+                    row = self.transitions[letter1]
+                    row[letter2] -= 1
+                    if not row[letter2]:
+                        del row[letter2]
+                        if not row:
+                            del self.transitions[letter1]
+        self.first_letter = state[:1]
+        self.next_letters = end
+        self.next_start = start
+        new = state[max(self.letters - 1, start) - start:]
+        return (old_transitions, zip(new, new[1:]))
+
+    def get_model(self, position):
+        """ The id, the training prefix length, the prob and the letters scored of the model in this position. The id is 0 if none """
+        index = position * MODEL_SCORES
+        if index >= len(self.models):
+            return (0, 0, 0, 0)
+        return tuple(self.models[index:index + MODEL_SCORES])
+
+    def set_model(self, position, model_id, prefixlen, probability, letters):
+        index = position * MODEL_SCORES
+        if index >= len(self.models):
+            self.models.extend([0] * (index + MODEL_SCORES - len(self.models)))
+        self.models[index:index + MODEL_SCORES] = array('l', (model_id, prefixlen, probability, letters))
+
+    def add_transitions(self, new_transitions):
+        """ Store the new transitions after all the models used them """
+        for (letter1, letter2) in new_transitions:
+            row = self.transitions.setdefault(letter1, {})
+            row[letter2] = row.get(letter2, 0) + 1
+        self.letters = self.next_letters
+        self.start = self.next_start
+
+
+class BatchScorer():
+    """
+    Score a tuple against all the models of one protocol at once with numpy.
+    Only the models whose whole training state is covered by the tuple state are scored here, because their matrix does
+    not change anymore and their compiled tables can be stacked. The models with longer training states are scored one by one.
+    The probs are floats, so when transitions leave the window of the tuple they are computed again instead of
+    subtracted, which would make them drift.
+    """
+    def __init__(self, models):
+        # Sort by the length of the training state, so the models covered by a tuple state are always the first ones
+        models = sorted(models, key=lambda (position, model): len(model.get_state()))
+        # The position of each model in the list of the detection. Used to break the ties as the loop over the models does
+        self.positions = numpy.array([position for (position, model) in models])
+        self.models = [model for (position, model) in models]
+        self.lengths = [len(model.get_state()) for model in self.models]
+        self.thresholds = numpy.array([model.get_threshold() for model in self.models], dtype=float)
+        # models x (letter1 * SIZE + letter2)
+        self.transitions = numpy.array([model.compiled.transitions for model in self.models], dtype=float)
+        self.init_vectors = numpy.array([model.compiled.init_vector for model in self.models], dtype=float)
+        # The training probs of the whole states. Computed when a tuple first covers them
+        self.training = numpy.zeros(len(self.models))
+        self.trained = 0
+
+    def detect(self, scores, old_transitions, new_transitions, letters, verbose):
+        """
+        Update the probs of the tuple with the new transitions and return the distance, the position and the model that
+        matched best, or False if none matched. The scores already do not have the old transitions, and still do not have the new ones.
+        """
+        # Amount of models covered by the tuple state
+        covered = bisect_right(self.lengths, letters)
+        if scores.batch is self and scores.batch_letters == scores.letters and not old_transitions:
+            probabilities = scores.batch_probabilities
+            previously_covered = scores.batch_covered
+        else:
+            probabilities = numpy.zeros(len(self.models))
+            previously_covered = 0
+        if covered > previously_covered:
+            # The newly covered models start with all the previous transitions of the tuple
+            pairs = []
+            amounts = []
+            for letter1, row in scores.transitions.iteritems():
+                for letter2, amount in row.iteritems():
+                    pairs.append(mc.SYMBOLS.get(letter1, mc.OTHER) * mc.SIZE + mc.SYMBOLS.get(letter2, mc.OTHER))
+                    amounts.append(amount)
+            if pairs:
+                probabilities[previously_covered:covered] = self.transitions[previously_covered:covered, pairs].dot(amounts)
+            for index in xrange(self.trained, covered):
+                self.training[index] = self.models[index].get_training_probability(self.lengths[index])
+            self.trained = max(self.trained, covered)
+        # Add each new transition to all the covered models at once
+        for (letter1, letter2) in new_transitions:
+            probabilities[:covered] += self.transitions[:covered, mc.SYMBOLS.get(letter1, mc.OTHER) * mc.SIZE + mc.SYMBOLS.get(letter2, mc.OTHER)]
+        scores.batch = self
+        scores.batch_probabilities = probabilities
+        scores.batch_covered = covered
+        scores.batch_letters = scores.next_letters
+        if not covered:
+            return (float('inf'), -1, False)
+        test = self.init_vectors[:covered, mc.SYMBOLS.get(scores.first_letter, mc.OTHER)] + probabilities[:covered]
+        train = self.training[:covered]
+        # The same distance of the detection, but for all the models
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            distances = numpy.where(train <= test, train / test, test / train)
+        distances[~numpy.isfinite(distances)] = -1
+        if verbose > 2:
+            for index in xrange(covered):
+                print '\t\tTrained Model: {}. Label: {}. Threshold: {}. Whole state scored in batch'.format(self.models[index].get_id(), self.models[index].get_label(), self.models[index].get_threshold())
+                print '\t\t\tTrain prob: {}'.format(train[index])
+                print '\t\t\tTest prob: {}'.format(test[index])
+                print '\t\t\tDistance: {}'.format(distances[index])
+        distances = numpy.where((distances >= 1) & (distances <= self.thresholds[:covered]), distances, numpy.inf)
+        best = numpy.argmin(distances)
+        if distances[best] == numpy.inf:
+            return (float('inf'), -1, False)
+        # If several models have the same distance, the first one in the list of models wins
+        candidates = numpy.flatnonzero(distances == distances[best])
+        best = candidates[numpy.argmin(self.positions[candidates])]
+        return (float(distances[best]), int(self.positions[best]), self.models[best])
+
 
 class MarkovModelsDetection():
     """
@@ -138,15 +546,102 @@ class MarkovModelsDetection():
     """
     def __init__(self):
         self.models = []
+        # The position in self.models and the model, by lowercase protocol
+        self.protocols = {}
+        # Models scored one by one and in batches, and models of other protocols that were not visited
+        self.evaluated = 0
+        self.batched = 0
+        self.avoided = 0
+        # Transitions not scored from scratch, by detect_state() and detect(), because the model could not match anymore
+        self.skipped = 0
+        # Times each model scored a tuple and the seconds it took, by label. The batches are batch:protocol. Only one of
+        # each MODEL_TIMES_SAMPLE detections is timed, because timing each model costs almost as much as scoring it
+        self.model_scores = {}
+        self.model_seconds = {}
+        self.detections = 0
+        self.early_abandon = True
+        # The id of the last model added. The ids are never reused, because the scores of the tuples are checked with the model id
+        self.last_id = 0
+        # When reloading, the models already loaded by fingerprint. They are used again instead of the ones read
+        self.known = {}
+        # Do not print the models added
+        self.quiet = False
+        self.periodic = PatternMatcher(BASIC_PERIODIC_PATTERNS)
+        # Score the models with numpy. The batch of models of each protocol is created when needed
+        self.batch = False
+        self.batches = {}
+
+    def set_batch(self, batch):
+        if batch and not numpy:
+            print 'The numpy library is not installed. pip install numpy. The models are scored one by one.'
+            batch = False
+        self.batch = batch
+        self.batches = {}
+
+    def get_batch(self, protocol):
+        """ Return the batch of compiled models of this protocol """
+        protocol = protocol.lower()
+        try:
+            return self.batches[protocol]
+        except KeyError:
+            models = [(position, model) for (position, model) in self.get_models(protocol) if model.compiled]
+            if models:
+                self.batches[protocol] = BatchScorer(models)
+            else:
+                self.batches[protocol] = False
+            return self.batches[protocol]
+
+    def get_models(self, protocol):
+        """ The positions and models of this protocol """
+        return self.protocols.get(protocol.lower(), [])
+
+    def get_stats(self):
+        return 'Models: {} scored one by one, {} scored in batches, {} of other protocols not visited. {} transitions of whole states skipped.'.format(self.evaluated, self.batched, self.avoided, self.skipped)
+
+    def get_model_times(self):
+        """ The times each model scored a tuple and the seconds it took, by label """
+        return (self.model_scores, self.model_seconds)
+
+    def add_model_time(self, label, seconds):
+        self.model_scores[label] = self.model_scores.get(label, 0) + 1
+        self.model_seconds[label] = self.model_seconds.get(label, 0) + seconds
+
+    def set_periodic_patterns(self, patterns):
+        """ Use these patterns to find periodic states, besides the basic ones """
+        self.periodic = PatternMatcher(BASIC_PERIODIC_PATTERNS + list(patterns))
 
-    def is_periodic(self,state):
-        basic_patterns = ['a,a,a,','b,b,b,', 'c,c,c,', 'd,d,d,', 'e,e,e,', 'f,f,f,', 'g,g,g,', 'h,h,h,', 'i,i,i,', 'a+a+a+', 'b+b+b+', 'c+c+c+', 'd+d+d+', 'e+e+e+', 'f+f+f+', 'g+g+g+', 'h+h+h+', 'i+i+i+', 'a*a*a*', 'b*b*b*', 'c*c*c*', 'd*d*d*', 'e*e*e*', 'f*f*f*', 'g*g*g*', 'h*h*h*', 'i*i*i*', 'A,A,A,','B,B,B,', 'C,C,C,', 'D,D,D,', 'E,E,E,', 'F,F,F,', 'G,G,G,', 'H,H,H,', 'I,I,I,', 'A+A+A+', 'B+B+B+', 'C+C+C+', 'D+D+D+', 'E+E+E+', 'F+F+F+', 'G+G+G+', 'H+H+H+', 'I+I+I+', 'A*A*A*', 'B*B*B*', 'C*C*C*', 'D*D*D*', 'E*E*E*', 'F*F*F*', 'G*G*G*', 'H*H*H*', 'I*I*I*']
-        for pattern in basic_patterns:
-            if pattern in state:
-                return True
+    def read_periodic_patterns(self, file):
+        """ Add the patterns of a file, one per line, to the basic ones. The lines starting with # are comments """
+        with open(file) as input:
+            self.set_periodic_patterns([line.strip() for line in input if line.strip() and not line.startswith('#')])
+
+    def is_periodic(self, state):
+        return self.periodic.search(state)[1] >= 0
+
+    def is_tuple_periodic(self, tuple):
+        """ Whether the window of the tuple state has a periodic pattern. Only the letters added since the last time are read """
+        scores = tuple.get_scores()
+        if not scores:
+            scores = TupleScores()
+            tuple.set_scores(scores)
+        end = tuple.get_state_len()
+        letters = tuple.get_letters(scores.periodic_letters, end)
+        if scores.periodic_matcher is not self.periodic or letters is False:
+            # The patterns changed or the letters are not known anymore. Read the whole window again
+            scores.periodic_matcher = self.periodic
+            scores.periodic_node = 0
+            scores.periodic_match = -1
+            scores.periodic_letters = tuple.get_state_start()
+            letters = tuple.get_state()
+        (scores.periodic_node, match) = self.periodic.search(letters, scores.periodic_node, scores.periodic_letters)
+        scores.periodic_match = max(scores.periodic_match, match)
+        scores.periodic_letters = end
+        return scores.periodic_match >= tuple.get_state_start()
 
     def set_models_folder(self, folder):
-        """ Read the folder with models if specified """
+        """ Read the folder with models if specified. It can also be a bundle of models created with write_models_bundle() """
+        if isfile(folder):
+            return self.set_models_bundle(folder)
         try:
             onlyfiles = [f for f in listdir(folder) if isfile(join(folder, f))]
             for file in onlyfiles:
@@ -156,25 +651,235 @@ class MarkovModelsDetection():
             print 'Inexistent directory for folders.'
             return False
 
+    def get_new_model(self):
+        self.last_id += 1
+        return Model(self.last_id)
+
+    def get_known_model(self, model):
+        """ The model already loaded with the same fingerprint, or False """
+        return self.known.pop(model.get_fingerprint(), False)
+
+    def add_model(self, model):
+        """ Add a model that is ready to detect to the list, and to the indexes by protocol """
+        position = len(self.models)
+        self.models.append(model)
+        self.protocols.setdefault(model.get_protocol().lower(), []).append((position, model))
+        # The batches should include the new model
+        self.batches = {}
+        if not self.quiet:
+            print '\tAdding model {} to the list.'.format(model.get_label())
+
     def set_model_to_detect(self, file):
         """
         Receives a file and extracts the model in it
         """
         input = open(file, 'r')
-        try:
-            id = self.models[-1].get_id() + 1
-        except (KeyError, IndexError):
-            id = 1
-        model = Model(id)
+        model = self.get_new_model()
         model.set_init_vector(cPickle.load(input))
         model.set_matrix(cPickle.load(input))
         model.set_state(cPickle.load(input))
         model.set_self_probability(cPickle.load(input))
         model.set_label(cPickle.load(input))
         model.set_threshold(cPickle.load(input))
-        self.models.append(model)
-        print '\tAdding model {} to the list.'.format(model.get_label())
         input.close()
+        known = self.get_known_model(model)
+        if known:
+            self.add_model(known)
+            return
+        model.index_prefixes()
+        model.compile()
+        self.add_model(model)
+
+    def write_models_bundle(self, file):
+        """
+        Write the models in a bundle that loads much faster than the folder: the states, the compiled tables and the
+        positions of the transitions are stored as they are in memory, so they are only copied when loaded.
+        """
+        index = {'alphabet': mc.ALPHABET, 'penalty': PENALTY, 'byteorder': sys.byteorder, 'models': []}
+        data = []
+        size = 0
+        for model in self.models:
+            # The positions of all the transitions, and then of all the letters that start them
+            positions = array('i')
+            pairs = []
+            for pair, values in sorted(model.pair_positions.iteritems()):
+                pairs.append((pair, len(positions), len(positions) + len(values)))
+                positions.extend(values)
+            sources = []
+            for letter, values in sorted(model.source_positions.iteritems()):
+                sources.append((letter, len(positions), len(positions) + len(values)))
+                positions.extend(values)
+            if model.compiled:
+                sections = [model.get_state(), model.compiled.init_vector.tostring() + model.compiled.transitions.tostring(), positions.tostring()]
+            else:
+                sections = [model.get_state(), '', positions.tostring()]
+            offsets = []
+            for section in sections:
+                offsets.append(size)
+                # Each section starts aligned to 8 bytes
+                section += '\0' * (-len(section) % 8)
+                data.append(section)
+                size += len(section)
+            index['models'].append({'label': model.get_label(), 'threshold': model.get_threshold(), 'self_probability': model.get_self_probability(),
+                                    'init_vector': model.get_init_vector(), 'matrix': model.get_matrix(),
+                                    'state': (offsets[0], len(model.get_state())), 'compiled': model.compiled and offsets[1],
+                                    'positions': (offsets[2], len(positions)), 'pairs': pairs, 'sources': sources})
+        index = cPickle.dumps(index, 2)
+        # Written aside and renamed, so a slips that reloads the bundle never reads it half written
+        with open(file + '.tmp', 'wb') as output:
+            output.write(struct.pack(BUNDLE_HEADER, BUNDLE_MAGIC, BUNDLE_VERSION, len(index)))
+            output.write(index)
+            output.write('\0' * (-(struct.calcsize(BUNDLE_HEADER) + len(index)) % 8))
+            for section in data:
+                output.write(section)
+        os.rename(file + '.tmp', file)
+        print 'Bundle {} written with {} models.'.format(file, len(self.models))
+
+    def set_models_bundle(self, file):
+        """ Read all the models of a bundle created with write_models_bundle() """
+        try:
+            with open(file, 'rb') as input:
+                bundle = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError) as e:
+            print 'The bundle of models {} can not be read: {}'.format(file, e)
+            return False
+        try:
+            header = struct.calcsize(BUNDLE_HEADER)
+            (magic, version, index_length) = struct.unpack(BUNDLE_HEADER, bundle[:header].ljust(header, '\0'))
+            if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+                print 'The file {} is not a bundle of models of version {}. Compile it again with -c.'.format(file, BUNDLE_VERSION)
+                return False
+            index = cPickle.loads(bundle[header:header + index_length])
+            if index['alphabet'] != mc.ALPHABET or index['penalty'] != PENALTY:
+                print 'The bundle of models {} was compiled with another alphabet or penalty. Compile it again with -c.'.format(file)
+                return False
+            # The sections start after the index, aligned to 8 bytes
+            start = header + index_length + (-(header + index_length) % 8)
+            for values in index['models']:
+                model = self.get_new_model()
+                model.set_init_vector(values['init_vector'])
+                model.set_matrix(values['matrix'])
+                (offset, length) = values['state']
+                model.set_state(bundle[start + offset:start + offset + length])
+                model.set_self_probability(values['self_probability'])
+                model.set_label(values['label'])
+                model.set_threshold(values['threshold'])
+                known = self.get_known_model(model)
+                if known:
+                    self.add_model(known)
+                    continue
+                (offset, length) = values['positions']
+                positions = self.read_bundle_array(bundle, 'i', start + offset, length, index['byteorder'])
+                model.set_prefix_index(dict((pair, positions[first:last]) for (pair, first, last) in values['pairs']),
+                                       dict((letter, positions[first:last]) for (letter, first, last) in values['sources']))
+                if values['compiled'] is not False:
+                    offset = start + values['compiled']
+                    init_vector = self.read_bundle_array(bundle, 'd', offset, mc.SIZE, index['byteorder'])
+                    transitions = self.read_bundle_array(bundle, 'd', offset + init_vector.itemsize * mc.SIZE, mc.SIZE * mc.SIZE, index['byteorder'])
+                    model.set_compiled(mc.CompiledMatrix.from_tables(init_vector, transitions, PENALTY))
+                self.add_model(model)
+            return True
+        finally:
+            bundle.close()
+
+    def read_bundle_array(self, bundle, typecode, offset, length, byteorder):
+        values = array(typecode)
+        values.fromstring(bundle[offset:offset + length * values.itemsize])
+        if byteorder != sys.byteorder:
+            values.byteswap()
+        return values
+
+    def reload_models(self, folder, quiet=False):
+        """
+        Read the models of the folder or bundle again, and return them in a new detection that can be given to swap_models().
+        The models that did not change are not read again. They are the same objects, with the same ids, so the scores
+        of the tuples for them are still valid while they keep their position in the list. False if the models can not be read.
+        """
+        models = MarkovModelsDetection()
+        models.last_id = self.last_id
+        models.known = dict((model.get_fingerprint(), model) for model in self.models)
+        models.quiet = quiet
+        if not models.set_models_folder(folder):
+            return False
+        models.known = {}
+        return models
+
+    def swap_models(self, models):
+        """
+        Detect from now on with the models of a detection created by reload_models(). Call it from the thread that
+        detects, so no detection sees half of the change. Return the amount of models unchanged, new and removed.
+        """
+        old = set(id(model) for model in self.models)
+        new = set(id(model) for model in models.models)
+        # The batches of the protocols whose models did not change keep the probs computed for the tuples
+        batches = dict((protocol, batch) for (protocol, batch) in self.batches.iteritems() if models.protocols.get(protocol) == self.protocols.get(protocol))
+        self.models = models.models
+        self.protocols = models.protocols
+        self.batches = batches
+        self.last_id = models.last_id
+        return (len(old & new), len(new - old), len(old - new))
+
+    def get_distance(self, training_original_prob, test_prob):
+        """ The distance between the training and the test probs. A match needs it between 1 and the threshold. -1 if it can not be computed """
+        prob_distance = -1
+        if training_original_prob != -1 and test_prob != -1 and training_original_prob <= test_prob:
+            try:
+                prob_distance = training_original_prob / test_prob
+            except ZeroDivisionError:
+                prob_distance = -1
+        elif training_original_prob != -1 and test_prob != -1 and training_original_prob > test_prob:
+            try:
+                prob_distance = test_prob / training_original_prob
+            except ZeroDivisionError:
+                prob_distance = -1
+        return prob_distance
+
+    def set_early_abandon(self, early_abandon):
+        """ Stop scoring a whole state against a model as soon as the model can not match, offline and when the running prob is computed from scratch """
+        self.early_abandon = early_abandon
+
+    def detect_state(self, state, protocol, verbose):
+        """
+        Detect a whole state, without keeping anything for the next letters. For offline use, when there are no running
+        probs to update. The result is the same that detect() gives for a tuple with this state.
+        The log probs of the transitions are never positive, so the test prob only goes down while the transitions are
+        added. As soon as the distance can not be below the threshold of the model and the best distance so far, the
+        rest of the transitions of that model are skipped.
+        """
+        best_model_so_far = False
+        best_distance_so_far = float('inf')
+        if len(state) < 4:
+            return (False, False, False)
+        transitions = {}
+        for pair in zip(state, state[1:]):
+            transitions[pair] = transitions.get(pair, 0) + 1
+        total = len(state) - 1
+        for position, model in self.get_models(protocol):
+            statelen = min(len(state), len(model.get_state()))
+            training_original_prob = model.get_training_probability(statelen)
+            limit = min(model.get_threshold(), best_distance_so_far)
+            probability = to_fixed(model.init_probability(state[0], statelen))
+            scored = 0
+            for (letter1, letter2), amount in transitions.iteritems():
+                if self.early_abandon and training_original_prob < 0 and from_fixed(probability) / training_original_prob > limit:
+                    # The test prob can only go down, so the distance can only grow
+                    break
+                probability += amount * model.transition_probability(letter1, letter2, statelen)
+                scored += amount
+            self.evaluated += 1
+            if scored < total:
+                self.skipped += total - scored
+                if verbose > 3:
+                    print '\t\tModel {} abandoned after {} of {} transitions'.format(model.get_label(), scored, total)
+                continue
+            prob_distance = self.get_distance(training_original_prob, from_fixed(probability))
+            if prob_distance >= 1 and prob_distance <= model.get_threshold() and prob_distance < best_distance_so_far:
+                model.set_best_model_matching_len(len(state))
+                best_model_so_far = model
+                best_distance_so_far = prob_distance
+        if best_model_so_far:
+            return (best_model_so_far.matched, best_model_so_far.get_label(), best_model_so_far.get_best_model_matching_len())
+        return (False, False, False)
 
     def detect(self, tuple, verbose):
         """
@@ -184,42 +889,71 @@ class MarkovModelsDetection():
             # Clear the temp best model
             best_model_so_far = False
             best_distance_so_far = float('inf')
+            best_position_so_far = -1
             # best_model_matching_len = -1
             # Set the verbose
             self.verbose = verbose
+            state = tuple.get_state()
+            # Get the new transitions of the tuple since the last detection
+            scores = tuple.get_scores()
+            if not scores:
+                scores = TupleScores()
+                tuple.set_scores(scores)
+            (old_transitions, new_transitions) = scores.get_changes(tuple, state)
             # Only detect states with more than 3 letters
-            if len(tuple.get_state()) < 4:
+            if len(state) < 4:
+                scores.add_transitions(new_transitions)
                 if self.verbose > 3:
                     print '\t-> State too small'
                 return (False, False, False)
-            # Use the current models for detection
-            for model in self.models:
-                # Only detect if protocol matches
-                if model.get_protocol().lower() != tuple.get_protocol().lower():
-                    # Go get the next
+            # The models whose whole training state is covered by the tuple are scored all at once
+            batch = False
+            if self.batch:
+                batch = self.get_batch(tuple.get_protocol())
+            self.detections += 1
+            timed = not self.detections % MODEL_TIMES_SAMPLE
+            if batch:
+                if timed:
+                    start = time.time()
+                (best_distance_so_far, best_position_so_far, best_model_so_far) = batch.detect(scores, old_transitions, new_transitions, len(state), self.verbose)
+                if timed:
+                    self.add_model_time('batch:' + tuple.get_protocol().lower(), time.time() - start)
+                if best_model_so_far:
+                    best_model_so_far.set_best_model_matching_len(tuple.get_state_len())
+            # Use the current models for detection. Only the ones of the protocol of the tuple
+            models = self.get_models(tuple.get_protocol())
+            self.avoided += len(self.models) - len(models)
+            if batch:
+                self.batched += scores.batch_covered
+            for position, model in models:
+                if batch and model.compiled and len(model.get_state()) <= len(state):
+                    # Already scored in the batch
                     continue
                 # Letters of the trained model. Get from the last detected letter to the end. NO CUT HERE. We dont cut the training letters, because if we do, we have to cut ALL of them,
                 # including the matching and the not matching ones.
-                train_sequence = model.get_state()[0:len(tuple.get_state())]
-                # Recreate the matrix so far
-                model.create(train_sequence)
-                # Get the new original prob so far...
-                training_original_prob = model.compute_probability(train_sequence)
+                # The matrix of the training letters so far is not created again. The model knows the probabilities of all its prefixes, and the prob of the
+                # tuple is updated only with the new letters.
                 # Now obtain the probability for testing. The prob is computed by using the API on the train model, which knows its own matrix
-                test_prob = model.compute_probability(tuple.get_state())
+                if timed:
+                    start = time.time()
+                limit = False
+                if self.early_abandon:
+                    limit = min(model.get_threshold(), best_distance_so_far)
+                (train_len, test_prob, skipped) = model.update_scores(scores, position, old_transitions, new_transitions, len(state), limit)
+                if timed:
+                    self.add_model_time(model.get_label(), time.time() - start)
+                self.evaluated += 1
+                if test_prob is False:
+                    self.skipped += skipped
+                    if self.verbose > 3:
+                        print '\t\tModel {} abandoned with {} transitions not scored'.format(model.get_label(), skipped)
+                    continue
+                # Get the new original prob so far...
+                training_original_prob = model.get_training_probability(train_len)
                 # Get the distance
-                prob_distance = -1
-                if training_original_prob != -1 and test_prob != -1 and training_original_prob <= test_prob:
-                    try:
-                        prob_distance = training_original_prob / test_prob
-                    except ZeroDivisionError:
-                        prob_distance = -1
-                elif training_original_prob != -1 and test_prob != -1 and training_original_prob > test_prob:
-                    try:
-                        prob_distance = test_prob / training_original_prob
-                    except ZeroDivisionError:
-                        prob_distance = -1
+                prob_distance = self.get_distance(training_original_prob, test_prob)
                 if self.verbose > 2:
+                    train_sequence = model.get_state()[0:train_len]
                     print '\t\tTrained Model: {}. Label: {}. Threshold: {}, State: {}'.format(model.get_id(), model.get_label(), model.get_threshold(), train_sequence)
                     print '\t\t\tTest Model: {}. State: {}'.format(tuple.get_id(), tuple.get_state())
                     print '\t\t\tTrain prob: {}'.format(training_original_prob)
@@ -227,18 +961,20 @@ class MarkovModelsDetection():
                     print '\t\t\tDistance: {}'.format(prob_distance)
                     if self.verbose > 4:
                         print '\t\t\tTrained Matrix:'
-                        matrix = model.get_matrix()
+                        (init_vector, matrix) = mc.maximum_likelihood_probabilities(list(train_sequence), order=1)
                         for i in matrix:
                             print '\t\t\t\t{}:{}'.format(i, matrix[i])
                 # If we matched and we are the best so far
-                if prob_distance >= 1 and prob_distance <= model.get_threshold() and prob_distance < best_distance_so_far:
+                if prob_distance >= 1 and prob_distance <= model.get_threshold() and (prob_distance < best_distance_so_far or (prob_distance == best_distance_so_far and position < best_position_so_far)):
                     # Store for this model, where it had its match. Len of the state. So later we can cut the state.
-                    model.set_best_model_matching_len(len(tuple.get_state()))
+                    model.set_best_model_matching_len(tuple.get_state_len())
                     # Now store the best
                     best_model_so_far = model
                     best_distance_so_far = prob_distance
+                    best_position_so_far = position
                     if self.verbose > 3:
-                        print '\t\t\t\tThis model is the best so far. State len: {}'.format(len(tuple.get_state()))
+                        print '\t\t\t\tThis model is the best so far. State len: {}'.format(len(state))
+            scores.add_transitions(new_transitions)
             # If we detected something
             if best_model_so_far:
                 return (best_model_so_far.matched, best_model_so_far.get_label(), best_model_so_far.get_best_model_matching_len())
@@ -0,0 +1,162 @@
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+import os
+from bisect import bisect_left
+
+# Upper bounds of the buckets of the histograms, in seconds. From 10 microseconds to 10 seconds
+BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# The type and the help of each metric. The names are the ones used with the Metrics, without the slips_ prefix
+METRICS = {
+    'lines': ('counter', 'Lines received by the processor.'),
+    'parse_errors': ('counter', 'Lines that could not be parsed and were dropped.'),
+    'flows': ('counter', 'Flows added to their tuple.'),
+    'ignored_flows': ('counter', 'Flows dropped because their time is before the current time slot.'),
+    'out_of_order_flows': ('counter', 'Flows older than a flow received before them.'),
+    'late_flows': ('counter', 'Flows older than the flows already processed after reordering them. They are processed at once, or ignored if their time slot finished.'),
+    'reorder_overflows': ('counter', 'Flows processed before their reorder delay because the reorder buffer was full.'),
+    'reorder_buffer': ('gauge', 'Flows waiting to be processed sorted by time.'),
+    'batches': ('counter', 'Batches of lines received by the processor.'),
+    'slots': ('counter', 'Time slots finished.'),
+    'reloads': ('counter', 'Reloads of the models.'),
+    'queue_wait_seconds': ('counter', 'Seconds the processor waited for the next batch of lines.'),
+    'queue_depth': ('gauge', 'Batches of lines waiting in the queue of the processor.'),
+    'tuples': ('gauge', 'Tuples kept in memory.'),
+    'batch_seconds': ('histogram', 'Seconds to process each batch of lines.'),
+    'parse_seconds': ('histogram', 'Seconds to split and parse the time of the lines. One of each 8 lines is timed.'),
+    'add_flow_seconds': ('histogram', 'Seconds to add the flows to their tuple and compute their letters. One of each 8 flows is timed.'),
+    'detect_seconds': ('histogram', 'Seconds to detect each tuple against the models.'),
+    'slot_flush_seconds': ('histogram', 'Seconds to report and clean each finished time slot.'),
+    'checkpoints': ('counter', 'Checkpoints of the state of the tuples started.'),
+    'checkpoint_errors': ('counter', 'Checkpoints that could not be written.'),
+    'checkpoint_pause_seconds': ('histogram', 'Seconds the processing stopped to start each checkpoint, which is written in the background.'),
+    'model_scores': ('counter', 'Times each model scored a tuple, in the timed detections (one of each 16). The models scored in batches count as batch:protocol.'),
+    'model_score_seconds': ('counter', 'Seconds each model spent scoring the tuples, in the timed detections (one of each 16).'),
+}
+
+
+class Histogram(object):
+    """ The amount of values in each bucket, and their sum. Merged by adding the buckets """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last one is for the values bigger than all the buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for (index, amount) in enumerate(other.counts):
+            self.counts[index] += amount
+        self.sum += other.sum
+        self.count += other.count
+
+    def get_quantile(self, quantile):
+        """ The upper bound of the bucket where the quantile is. 0 without values, inf if it is after the last bucket """
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        seen = 0
+        for (index, amount) in enumerate(self.counts):
+            seen += amount
+            if seen >= rank and amount:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms of the processing. They are only additions to dicts, cheap enough to be always
+    used. The metrics of other processes can be merged to export them together, in the text format of Prometheus.
+    """
+    def __init__(self):
+        self.values = {}
+        self.histograms = {}
+        # Values by label, like the scores of each model
+        self.labelled = {}
+
+    def inc(self, name, amount=1):
+        self.values[name] = self.values.get(name, 0) + amount
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def get(self, name):
+        return self.values.get(name, 0)
+
+    def observe(self, name, value):
+        self.get_histogram(name).observe(value)
+
+    def get_histogram(self, name):
+        """ The histogram of the name, created if needed. Keep it to observe the values of each flow without looking for it """
+        try:
+            return self.histograms[name]
+        except KeyError:
+            self.histograms[name] = Histogram()
+            return self.histograms[name]
+
+    def set_labelled(self, name, values):
+        """ The values of a metric by label. They are kept by their owner, e.g. the detection, and copied here """
+        self.labelled[name] = dict(values)
+
+    def merge(self, other):
+        """ Add the metrics of another process. The gauges are added too, because they are of different shards """
+        for (name, value) in other.values.iteritems():
+            self.inc(name, value)
+        for (name, histogram) in other.histograms.iteritems():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+        for (name, values) in other.labelled.iteritems():
+            merged = self.labelled.setdefault(name, {})
+            for (label, value) in values.iteritems():
+                merged[label] = merged.get(label, 0) + value
+
+    def copy(self):
+        copied = Metrics()
+        copied.merge(self)
+        return copied
+
+    def get_text(self):
+        """ All the metrics in the text format of Prometheus """
+        lines = []
+        for name in sorted(METRICS):
+            (type, help) = METRICS[name]
+            if name not in self.values and name not in self.histograms and name not in self.labelled:
+                continue
+            full_name = 'slips_' + name + ('_total' if type == 'counter' else '')
+            lines.append('# HELP {} {}'.format(full_name, help))
+            lines.append('# TYPE {} {}'.format(full_name, type))
+            if name in self.labelled:
+                for label in sorted(self.labelled[name]):
+                    lines.append('{}{{model="{}"}} {}'.format(full_name, label.replace('\\', '\\\\').replace('"', '\\"'), repr(self.labelled[name][label])))
+            elif type == 'histogram':
+                histogram = self.histograms[name]
+                seen = 0
+                for (bucket, amount) in zip(histogram.buckets, histogram.counts):
+                    seen += amount
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(full_name, repr(bucket), seen))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(full_name, histogram.count))
+                lines.append('{}_sum {}'.format(full_name, repr(histogram.sum)))
+                lines.append('{}_count {}'.format(full_name, histogram.count))
+            else:
+                lines.append('{} {}'.format(full_name, repr(self.values[name])))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file):
+        """ Write the metrics in the file, for the textfile collector of Prometheus. Renamed, so it is never read half written """
+        with open(file + '.tmp', 'w') as output:
+            output.write(self.get_text())
+        os.rename(file + '.tmp', file)
+
+    def get_stats_line(self, seconds, flows):
+        """ A summary of the metrics, with the flows per second since the previous one """
+        def quantiles(name):
+            histogram = self.get_histogram(name)
+            return '{:.2f}/{:.2f}'.format(histogram.get_quantile(0.5) * 1000, histogram.get_quantile(0.99) * 1000)
+        return 'Stats: {:.0f} flows/sec. {} flows, {} parse errors, {} ignored, {} out of order ({} late). Queue {}. {} tuples. Milliseconds p50/p99: add {}, detect {}, slot flush {}.'.format(
+            flows / seconds if seconds else 0, self.get('flows'), self.get('parse_errors'), self.get('ignored_flows'), self.get('out_of_order_flows'), self.get('late_flows'), self.get('queue_depth'),
+            self.get('tuples'), quantiles('add_flow_seconds'), quantiles('detect_seconds'), quantiles('slot_flush_seconds'))
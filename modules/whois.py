@@ -0,0 +1,167 @@
+# This file is part of the Stratosphere Linux IPS
+# See the file 'LICENSE' for copying permission.
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from Queue import Queue, Full
+try:
+    import ipwhois
+except ImportError:
+    # Only needed to get the whois of the IPs
+    ipwhois = False
+
+# Shown instead of the whois while it is being looked up
+PENDING = 'whois pending'
+# The whois stored in the cache is looked up again after a week
+TTL = 7 * 24 * 3600
+
+
+def lookup_whois(ip):
+    """ Ask the whois servers for the description and country of the IP. Blocks until they answer """
+    try:
+        data = ipwhois.IPWhois(ip).lookup()
+        try:
+            return data['nets'][0]['description'].strip().replace('\n', ' ') + ',' + data['nets'][0]['country']
+        except AttributeError:
+            # There is no description field
+            return ''
+    except ipwhois.IPDefinedError as e:
+        if 'Multicast' in str(e):
+            return 'Multicast'
+        return 'Private Use'
+    except ipwhois.ipwhois.WhoisLookupError:
+        print 'Error looking the whois of {}'.format(ip)
+        return ''
+    except (ValueError, IndexError):
+        # Not a real IP, maybe a MAC. Or some problem with the whois info
+        return ''
+
+
+class WhoisCache(object):
+    """
+    The whois of each IP in a SQLite file, so it is shared by all the processes and kept between runs.
+    The entries older than the ttl are looked up again, and when there are more than max_entries the least used are deleted.
+    Each thread uses its own connection.
+    """
+    def __init__(self, file, ttl=TTL, max_entries=100000):
+        self.file = file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+        # Inserts since the last eviction
+        self.inserts = 0
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        try:
+            return self.local.connection
+        except AttributeError:
+            connection = sqlite3.connect(self.file, timeout=10)
+            # The whois are printed with str.format, as the rest of the tuple
+            connection.text_factory = str
+            # The readers do not wait for the writers of other processes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS whois (ip TEXT PRIMARY KEY, description TEXT, stored REAL, used REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS whois_used ON whois (used)')
+            connection.commit()
+            self.local.connection = connection
+            return connection
+
+    def get(self, ip):
+        """ The whois of the IP, or None if it is not stored or is too old """
+        connection = self.get_connection()
+        now = time.time()
+        row = connection.execute('SELECT description FROM whois WHERE ip = ? AND stored >= ?', (ip, now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        connection.execute('UPDATE whois SET used = ? WHERE ip = ?', (now, ip))
+        connection.commit()
+        return row[0]
+
+    def put(self, ip, description):
+        connection = self.get_connection()
+        now = time.time()
+        connection.execute('INSERT OR REPLACE INTO whois VALUES (?, ?, ?, ?)', (ip, description, now, now))
+        connection.commit()
+        with self.lock:
+            self.inserts += 1
+            evict = self.inserts >= 100
+            if evict:
+                self.inserts = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """ Delete the old entries, and the least used ones if there are still too many """
+        connection = self.get_connection()
+        connection.execute('DELETE FROM whois WHERE stored < ?', (time.time() - self.ttl,))
+        (amount,) = connection.execute('SELECT COUNT(*) FROM whois').fetchone()
+        if amount > self.max_entries:
+            connection.execute('DELETE FROM whois WHERE ip IN (SELECT ip FROM whois ORDER BY used LIMIT ?)', (amount - self.max_entries,))
+        connection.commit()
+
+
+class WhoisResolver(object):
+    """
+    Get the whois of the IPs without blocking. The lookups are done by a few threads, and until the answer arrives the
+    whois is PENDING. The answers are stored in the cache, which is asked first.
+    The lookup is a function that receives an IP and returns its whois, so it can be replaced.
+    """
+    def __init__(self, cache, lookup=lookup_whois, threads=4, max_pending=1000, max_results=10000):
+        self.cache = cache
+        self.lookup = lookup
+        # The IPs waiting for a thread. When full, the IPs are asked again later
+        self.requests = Queue(max_pending)
+        # The IPs requested and not answered yet
+        self.pending = set()
+        # The last answers used, for the IPs of several tuples. The least recently used are forgotten first
+        self.results = OrderedDict()
+        self.max_results = max_results
+        self.lock = threading.Lock()
+        for index in range(threads):
+            thread = threading.Thread(target=self.resolve)
+            thread.daemon = True
+            thread.start()
+
+    def get_whois(self, ip):
+        """ The whois of the IP if it is known, or PENDING. Never waits """
+        with self.lock:
+            try:
+                # Move it to the end
+                description = self.results.pop(ip)
+                self.results[ip] = description
+                return description
+            except KeyError:
+                pass
+            if ip in self.pending:
+                return PENDING
+            try:
+                self.requests.put_nowait(ip)
+                self.pending.add(ip)
+            except Full:
+                pass
+        return PENDING
+
+    def resolve(self):
+        while True:
+            ip = self.requests.get()
+            try:
+                description = self.cache.get(ip)
+                if description is None:
+                    description = self.lookup(ip)
+                    self.cache.put(ip, description)
+            except Exception as inst:
+                print '\tProblem with resolve()'
+                print type(inst)     # the exception instance
+                print inst.args      # arguments stored in .args
+                print inst           # __str__ allows args to printed directly
+                # Asked again the next time
+                description = None
+            with self.lock:
+                self.pending.discard(ip)
+                if description is not None:
+                    self.results[ip] = description
+                    if len(self.results) > self.max_results:
+                        self.results.popitem(last=False)
@@ -10,46 +10,215 @@ from datetime import timedelta
 import argparse
 import multiprocessing
 from multiprocessing import Queue
+from Queue import Full, Empty
 import time
+import threading
+import calendar
+import itertools
+import os
+import glob
+import heapq
+import cStringIO
+import cPickle
+import gc
+import signal
+import select
+import socket
+import subprocess
+import errno
+import re
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
 from modules.markov_models_1 import __markov_models__
-from os import listdir
-from os.path import isfile, join
+import modules.whois as whois
+import modules.metrics as metrics
+try:
+    import numpy
+except ImportError:
+    # Only needed to read the files offline
+    numpy = False
 
 version = '0.3.3alpha'
+# Changed when the values saved in the checkpoints change, so the old ones are not read
+CHECKPOINT_VERSION = 2
+
+
+class LetterEncoder(object):
+    """
+    Compute the letters of the flows of a tuple. The letter depends on the periodicity, the size and the duration of the
+    flow, and it is followed by a symbol for the time since the previous flow. Each value is classified with a bisect on
+    its thresholds and the letter is taken from a table.
+    """
+    # Default thresholds. The times are in seconds and the sizes in bytes
+    THRESHOLDS = {
+        # Each hour without flows adds a 0
+        'tto': 3600.0,
+        # TD (ratio between the last two times between flows) for strongly periodic, weakly periodic and weakly not periodic
+        'tt1': 1.05, 'tt2': 1.3, 'tt3': 5.0,
+        # Duration
+        'td1': 0.1, 'td2': 10.0,
+        # Size
+        'ts1': 250.0, 'ts2': 1100.0,
+        # Time since the previous flow for the symbols . , + *
+        'tp1': 5.0, 'tp2': 60.0, 'tp3': 300.0, 'tp4': 3600.0,
+    }
+    # The letters of each periodicity (not known, strongly periodic ... not periodic). Inside, by size and then duration
+    LETTERS = {-1: '123456789', 1: 'abcdefghi', 2: 'ABCDEFGHI', 3: 'rstuvwxyz', 4: 'RSTUVWXYZ'}
+    # After the last threshold of the time there is no symbol
+    SYMBOLS = ['.', ',', '+', '*', '']
+
+    def __init__(self, thresholds={}):
+        self.thresholds = dict(self.THRESHOLDS)
+        for name in thresholds:
+            if name not in self.THRESHOLDS:
+                raise ValueError('Unknown threshold {}'.format(name))
+            self.thresholds[name] = float(thresholds[name])
+        self.tto = self.thresholds['tto']
+        self.tt1 = self.thresholds['tt1']
+        self.periodic_limits = self.get_limits('tt2', 'tt3')
+        self.duration_limits = self.get_limits('td1', 'td2')
+        self.size_limits = self.get_limits('ts1', 'ts2')
+        self.symbol_limits = self.get_limits('tp1', 'tp2', 'tp3', 'tp4')
+        if self.tt1 > self.periodic_limits[0]:
+            raise ValueError('The threshold tt1 is bigger than tt2')
+        # The letter of each (periodic, size, duration)
+        self.table = {}
+        for periodic in self.LETTERS:
+            for size in range(1, 4):
+                for duration in range(1, 4):
+                    self.table[(periodic, size, duration)] = self.LETTERS[periodic][(size - 1) * 3 + duration - 1]
+
+    def get_limits(self, *names):
+        limits = [self.thresholds[name] for name in names]
+        if limits != sorted(limits):
+            raise ValueError('The thresholds {} should be in increasing order'.format(', '.join(names)))
+        return limits
+
+    @staticmethod
+    def parse_thresholds(text):
+        """ The thresholds from a text like td1=0.2,ts2=1500 """
+        thresholds = {}
+        if not text:
+            return thresholds
+        for item in text.split(','):
+            try:
+                (name, value) = item.split('=')
+                thresholds[name.strip()] = float(value)
+            except ValueError:
+                raise ValueError('The threshold {} should be name=number'.format(item))
+        return thresholds
+
+    def get_duration(self, duration):
+        """ 1 for short, 2 for medium and 3 for long flows """
+        return bisect_left(self.duration_limits, duration) + 1
+
+    def get_size(self, size):
+        """ 1 for small, 2 for medium and 3 for big flows """
+        return bisect_left(self.size_limits, size) + 1
+
+    def get_periodic(self, T1, T2):
+        """ The TD of the last two times between flows and its periodicity, from 1 (strongly periodic) to 4 """
+        try:
+            # Rounded to microseconds, as it was when TD was a timedelta
+            if T2 >= T1:
+                TD = round(T2 / T1, 6)
+            else:
+                TD = round(T1 / T2, 6)
+        except ZeroDivisionError:
+            TD = 1
+        if TD <= self.tt1:
+            return (TD, 1)
+        return (TD, bisect_right(self.periodic_limits, TD) + 2)
+
+    def get_zeros(self, T1, T2):
+        """ One 0 for each hour of the last time between flows that is longer than an hour. False is an unknown time """
+        if isinstance(T1, bool) or isinstance(T2, bool):
+            return ''
+        elif T2 >= self.tto:
+            return '0' * int(T2 / self.tto)
+        elif T1 >= self.tto:
+            return '0' * int(T1 / self.tto)
+        return ''
+
+    def get_letter(self, periodic, size, duration):
+        return self.table[(periodic, size, duration)]
+
+    def get_symbol(self, T2):
+        return self.SYMBOLS[bisect_left(self.symbol_limits, T2)]
+
+    def encode_flows(self, starttimes, durations, sizes):
+        """
+        The state of a whole tuple at once with numpy, for offline use. The starttimes are in seconds since the epoch and
+        sorted. The result is the same as adding the flows one by one to a Tuple.
+        """
+        T2 = numpy.full(len(starttimes), numpy.nan)
+        # Rounded as the tuples round them
+        T2[1:] = [round(value, 6) for value in numpy.diff(numpy.array(starttimes, dtype=float)).tolist()]
+        T1 = numpy.full(len(starttimes), numpy.nan)
+        T1[1:] = T2[:-1]
+        return ''.join(self.encode_columns(T1, T2, numpy.array(sizes, dtype=float), numpy.array(durations, dtype=float))[0])
+
+    def encode_columns(self, T1, T2, sizes, durations):
+        """
+        The letters of many flows at once with numpy. The arrays have the two last times between flows of the tuple of
+        each flow, with NaN when they are not known yet, and its size and duration.
+        Return the letters of each flow, the letter it has when its periodicity is not known, and its symbol.
+        """
+        known = ~numpy.isnan(T1) & ~numpy.isnan(T2)
+        size = numpy.searchsorted(self.size_limits, sizes, 'left')
+        duration = numpy.searchsorted(self.duration_limits, durations, 'left')
+        # The flows without both times keep the periodic of a new tuple
+        periodic = numpy.full(len(T1), -1, dtype=int)
+        zeros = numpy.zeros(len(T1), dtype=int)
+        if known.any():
+            (t1, t2) = (T1[known], T2[known])
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                ratios = numpy.where(t2 >= t1, t2 / t1, t1 / t2)
+            divisors = numpy.where(t2 >= t1, t1, t2)
+            # The rounding of python, because the one of numpy may differ in the last digit
+            TD = numpy.array([1 if divisor == 0 else round(ratio, 6) for (ratio, divisor) in zip(ratios.tolist(), divisors.tolist())])
+            periodic[known] = numpy.where(TD <= self.tt1, 1, numpy.searchsorted(self.periodic_limits, TD, 'right') + 2)
+            zeros[known] = numpy.where(t2 >= self.tto, t2 / self.tto, numpy.where(t1 >= self.tto, t1 / self.tto, 0)).astype(int)
+        symbol = numpy.where(numpy.isnan(T2), len(self.SYMBOLS) - 1, numpy.searchsorted(self.symbol_limits, T2, 'left'))
+        position = (size * 3 + duration).tolist()
+        symbols = [self.SYMBOLS[index] for index in symbol.tolist()]
+        letters = ['0' * amount + self.LETTERS[kind][index] + mark for (amount, kind, index, mark) in zip(zeros.tolist(), periodic.tolist(), position, symbols)]
+        plain = [self.LETTERS[-1][index] for index in position]
+        return (letters, plain, symbols)
+
 
 ###################
 class Tuple(object):
     """ The class to simply handle tuples """
-    def __init__(self, tuple4):
+    # There can be hundreds of thousands of tuples, so they have no __dict__
+    __slots__ = ['id', 'amount_of_flows', 'src_ip', 'dst_ip', 'protocol', 'datetime', 'T1', 'T2', 'TD', 'current_size', 'current_duration',
+                 'previous_time', 'encoder', 'state', 'state_offset', 'window', 'duration', 'size', 'periodic', 'color', 'should_be_printed',
+                 'desc', 'min_state_len', 'max_state_len', 'detected_label', 'periodic_pattern', 'scores', 'verbose']
+
+    def __init__(self, tuple4, encoder, window=200):
         self.id = tuple4
         self.amount_of_flows = 0
-        self.src_ip = tuple4.split('-')[0]
-        self.dst_ip = tuple4.split('-')[1]
-        self.protocol = tuple4.split('-')[3]
-        self.state_so_far = ""
-        self.winner_model_id = False
-        self.winner_model_distance = float('inf')
-        self.proto = ""
+        # The same IPs and protocols are in many tuples, so they are interned
+        values = tuple4.split('-')
+        self.src_ip = intern(values[0])
+        self.dst_ip = intern(values[1])
+        self.protocol = intern(values[3])
         self.datetime = ""
         self.T1 = False
         self.T2 = False
         self.TD = False
         self.current_size = -1
         self.current_duration = -1
-        self.previous_size = -1
-        self.previous_duration = -1
         self.previous_time = -1
-        # Thresholds
-        self.tto = timedelta(seconds=3600)
-        self.tt1 = float(1.05)
-        self.tt2 = float(1.3)
-        self.tt3 = float(5)
-        self.td1 = float(0.1)
-        self.td2 = float(10)
-        self.ts1 = float(250)
-        self.ts2 = float(1100)
-        # The state
-        self.state = ""
+        # The thresholds to get the letters are in the encoder, which is shared by all the tuples
+        self.encoder = encoder
+        # The last letters of the state. Only the last window letters are used, but up to twice of them are kept so
+        # the old ones are deleted once in a while and not with each flow. The positions of the letters in the state,
+        # like min_state_len and max_state_len, count all the letters since the first flow.
+        self.state = bytearray()
+        # Amount of letters deleted from the start of the state
+        self.state_offset = 0
+        self.window = window
         # Final values for getting the state
         self.duration = -1
         self.size = -1
@@ -65,6 +234,17 @@ class Tuple(object):
         # where the detection happened. The new arriving letters to be detected are between max_state_len and the real end of the state
         self.max_state_len = 0
         self.detected_label = False
+        # If the window of the state has a periodic pattern. Only known when the processor looks for them
+        self.periodic_pattern = False
+        # The running probabilities of the state against the models, kept by the detection
+        self.scores = False
+        self.verbose = 0
+
+    def get_scores(self):
+        return self.scores
+
+    def set_scores(self, scores):
+        self.scores = scores
 
     def set_detected_label(self, label):
         self.detected_label = label
@@ -75,12 +255,19 @@ class Tuple(object):
     def get_detected_label(self):
         return self.detected_label
 
+    def set_periodic_pattern(self, periodic_pattern):
+        self.periodic_pattern = periodic_pattern
+
+    def get_periodic_pattern(self):
+        return self.periodic_pattern
+
     def get_state_detected_last(self):
+        start = max(self.min_state_len, self.get_state_start())
         if self.max_state_len == 0:
             # First time before any detection
-            return self.state[self.min_state_len:]
+            return self.get_letters(start, self.get_state_len())
         # After the first detection
-        return self.state[self.min_state_len:self.max_state_len]
+        return self.get_letters(start, max(start, self.max_state_len))
 
     def set_min_state_len(self, state_len):
         self.min_state_len = state_len
@@ -98,57 +285,58 @@ class Tuple(object):
         return self.protocol
 
     def get_state(self):
-        return self.state
+        """ The last window letters of the state """
+        return str(self.state[-self.window:])
+
+    def get_state_len(self):
+        """ Amount of letters of the state since the first flow """
+        return self.state_offset + len(self.state)
+
+    def get_state_start(self):
+        """ Position of the first letter of the window """
+        return max(0, self.get_state_len() - self.window)
+
+    def get_letters(self, start, end):
+        """ The letters between these positions. False if some of them were already deleted """
+        if start < self.state_offset:
+            return False
+        return str(self.state[start - self.state_offset:end - self.state_offset])
+
+    def add_letters(self, letters):
+        if len(self.state) >= 2 * self.window:
+            # Keep only the window. The detection of the last flow still needs its letters to know which ones leave it
+            amount = len(self.state) - self.window
+            del self.state[:amount]
+            self.state_offset += amount
+        self.state.extend(letters)
 
     def set_verbose(self, verbose):
         self.verbose = verbose
 
-    def get_whois_data(self):
-        try:
-            import ipwhois
-        except ImportError:
-            print 'The ipwhois library is not install. pip install ipwhois'
-            return False
-        # is the ip in the cache
-        try:
-            self.desc = whois_cache[self.dst_ip]
-        except KeyError:
-            # Is not, so just ask for it
-            try:
-                obj = ipwhois.IPWhois(self.dst_ip)
-                data = obj.lookup()
-                try:
-                    self.desc = data['nets'][0]['description'].strip().replace('\n',' ') + ',' + data['nets'][0]['country']
-                except AttributeError:
-                    # There is no description field
-                    self.desc = ""
-            except ipwhois.IPDefinedError as e:
-                if 'Multicast' in e:
-                    self.desc = 'Multicast'
-                self.desc = 'Private Use'
-            except ipwhois.ipwhois.WhoisLookupError:
-                print 'Error looking the whois of {}'.format(self.dst_ip)
-                # continue with the work
-            except ValueError:
-                # Not a real IP, maybe a MAC
-                pass
-            except IndexError:
-                # Some problem with the whois info. Continue
-                pass
-            # Store in the cache
-            whois_cache[self.dst_ip] = self.desc
-
-    def add_new_flow(self, column_values):
-        """ Add new stuff about the flow in this tuple """
+    def set_whois_data(self, desc):
+        self.desc = desc
+
+    def get_checkpoint(self):
+        """ The values needed to continue the tuple after a restart. Only the letters of the window are kept """
+        return (self.id, self.amount_of_flows, self.datetime, self.T2, self.periodic, str(self.state[-self.window:]), self.get_state_len(),
+                self.min_state_len, self.max_state_len, self.detected_label, self.should_be_printed, self.color, self.desc if self.desc != whois.PENDING else '')
+
+    def set_checkpoint(self, values):
+        """ Continue the tuple from the values of get_checkpoint. The scores are computed again by the next detection """
+        (id, self.amount_of_flows, self.datetime, self.T2, self.periodic, letters, state_len, self.min_state_len, self.max_state_len,
+         self.detected_label, self.should_be_printed, self.color, self.desc) = values
+        self.state = bytearray(letters)
+        self.state_offset = state_len - len(letters)
+
+    def add_new_flow(self, column_values, flowtime):
+        """ Add new stuff about the flow in this tuple. The flowtime is the starttime in seconds since the epoch """
         # 0:starttime, 1:dur, 2:proto, 3:saddr, 4:sport, 5:dir, 6:daddr: 7:dport, 8:state, 9:stos,  10:dtos, 11:pkts, 12:bytes
         # Store previous
-        self.previous_size = self.current_size
-        self.previous_duration = self.current_duration
         self.previous_time = self.datetime
         if self.verbose > 2:
             print '\nAdding flow {}'.format(column_values)
         # Get the starttime
-        self.datetime = datetime.strptime(column_values[0], '%Y/%m/%d %H:%M:%S.%f')
+        self.datetime = flowtime
         # Get the size
         try:
             self.current_size = float(column_values[12])
@@ -161,226 +349,71 @@ class Tuple(object):
         except ValueError:
             # It can happen that we dont have this value in the binetflow
             self.current_duration = 0.0
-        # Get the protocol
-        self.proto = str(column_values[2])
         # Get the amount of flows
         self.amount_of_flows += 1
         # Update value of T1
         self.T1 = self.T2
         try:
-            # Update value of T2
-            self.T2 = self.datetime - self.previous_time
+            # Update value of T2. The error of the float times is far below a microsecond, so round it to the microseconds of the flows
+            self.T2 = round(self.datetime - self.previous_time, 6)
             # Are flows sorted?
-            if self.T2.total_seconds() < 0:
+            if self.T2 < 0:
                 # Flows are not sorted
                 if self.verbose > 2:
                     print '@',
-                # What is going on here when the flows are not ordered?? Are we losing flows?
+                # The flow is older than the previous one of the tuple. The processor counts them, and sorts them with -O
         except TypeError:
             self.T2 = False
         # Compute the rest
-        self.compute_periodicity()
-        self.compute_duration()
-        self.compute_size()
-        self.compute_state()
-        self.compute_symbols()
+        self.compute_letters()
+        self.do_print()
+        if self.verbose > 1:
+            print '\tTuple {}. Amount of flows so far: {}'.format(self.get_id(), self.amount_of_flows)
+
+    def add_encoded_flow(self, letters, flowtime):
+        """ Add a flow whose letters were already computed, as the offline analysis does """
+        self.previous_time = self.datetime
+        self.datetime = flowtime
+        self.amount_of_flows += 1
+        self.add_letters(letters)
         self.do_print()
         if self.verbose > 1:
             print '\tTuple {}. Amount of flows so far: {}'.format(self.get_id(), self.amount_of_flows)
 
-    def compute_periodicity(self):
-        # If either T1 or T2 are False
-        if (isinstance(self.T1, bool) and self.T1 == False) or (isinstance(self.T2, bool) and self.T2 == False):
-            self.periodicity = -1
-        elif self.T2 >= self.tto:
-            t2_in_hours = self.T2.total_seconds() / self.tto.total_seconds()
-            # Should be int always
-            for i in range(int(t2_in_hours)):
-                self.state += '0'
-        elif self.T1 >= self.tto:
-            t1_in_hours = self.T1.total_seconds() / self.tto.total_seconds()
-            # Should be int always
-            for i in range(int(t1_in_hours)):
-                self.state += '0'
+    def compute_letters(self):
+        """ Add the letters of the last flow to the state """
+        encoder = self.encoder
+        letters = ''
         if not isinstance(self.T1, bool) and not isinstance(self.T2, bool):
-            try:
-                if self.T2 >= self.T1:
-                    self.TD = timedelta(seconds=(self.T2.total_seconds() / self.T1.total_seconds())).total_seconds()
-                else:
-                    self.TD = timedelta(seconds=(self.T1.total_seconds() / self.T2.total_seconds())).total_seconds()
-            except ZeroDivisionError:
-                self.TD = 1
-            # Decide the periodic based on TD and the thresholds
-            if self.TD <= self.tt1:
-                # Strongly periodic
-                self.periodic = 1
-            elif self.TD < self.tt2:
-                # Weakly periodic
-                self.periodic = 2
-            elif self.TD < self.tt3:
-                # Weakly not periodic
-                self.periodic = 3
-            else:
-                self.periodic = 4
+            # The zeros of the long gaps
+            letters = encoder.get_zeros(self.T1, self.T2)
+            (self.TD, self.periodic) = encoder.get_periodic(self.T1, self.T2)
+        self.duration = encoder.get_duration(self.current_duration)
+        self.size = encoder.get_size(self.current_size)
+        letters += encoder.get_letter(self.periodic, self.size, self.duration)
+        if not isinstance(self.T2, bool):
+            letters += encoder.get_symbol(self.T2)
+        self.add_letters(letters)
         if self.verbose > 2:
             print '\tPeriodic: {}'.format(self.periodic)
-
-    def compute_duration(self):
-        if self.current_duration <= self.td1:
-            self.duration = 1
-        elif self.current_duration > self.td1 and self.current_duration <= self.td2:
-            self.duration = 2
-        elif self.current_duration > self.td2:
-            self.duration = 3
-        if self.verbose > 2:
             print '\tDuration: {}'.format(self.duration)
-
-    def compute_size(self):
-        if self.current_size <= self.ts1:
-            self.size = 1
-        elif self.current_size > self.ts1 and self.current_size <= self.ts2:
-            self.size = 2
-        elif self.current_size > self.ts2:
-            self.size = 3
-        if self.verbose > 2:
             print '\tSize: {}'.format(self.size)
-
-    def compute_state(self):
-        if self.periodic == -1:
-            if self.size == 1:
-                if self.duration == 1:
-                    self.state += '1'
-                elif self.duration == 2:
-                    self.state += '2'
-                elif self.duration == 3:
-                    self.state += '3'
-            elif self.size == 2:
-                if self.duration == 1:
-                    self.state += '4'
-                elif self.duration == 2:
-                    self.state += '5'
-                elif self.duration == 3:
-                    self.state += '6'
-            elif self.size == 3:
-                if self.duration == 1:
-                    self.state += '7'
-                elif self.duration == 2:
-                    self.state += '8'
-                elif self.duration == 3:
-                    self.state += '9'
-        elif self.periodic == 1:
-            if self.size == 1:
-                if self.duration == 1:
-                    self.state += 'a'
-                elif self.duration == 2:
-                    self.state += 'b'
-                elif self.duration == 3:
-                    self.state += 'c'
-            elif self.size == 2:
-                if self.duration == 1:
-                    self.state += 'd'
-                elif self.duration == 2:
-                    self.state += 'e'
-                elif self.duration == 3:
-                    self.state += 'f'
-            elif self.size == 3:
-                if self.duration == 1:
-                    self.state += 'g'
-                elif self.duration == 2:
-                    self.state += 'h'
-                elif self.duration == 3:
-                    self.state += 'i'
-        elif self.periodic == 2:
-            if self.size == 1:
-                if self.duration == 1:
-                    self.state += 'A'
-                elif self.duration == 2:
-                    self.state += 'B'
-                elif self.duration == 3:
-                    self.state += 'C'
-            elif self.size == 2:
-                if self.duration == 1:
-                    self.state += 'D'
-                elif self.duration == 2:
-                    self.state += 'E'
-                elif self.duration == 3:
-                    self.state += 'F'
-            elif self.size == 3:
-                if self.duration == 1:
-                    self.state += 'G'
-                elif self.duration == 2:
-                    self.state += 'H'
-                elif self.duration == 3:
-                    self.state += 'I'
-        elif self.periodic == 3:
-            if self.size == 1:
-                if self.duration == 1:
-                    self.state += 'r'
-                elif self.duration == 2:
-                    self.state += 's'
-                elif self.duration == 3:
-                    self.state += 't'
-            elif self.size == 2:
-                if self.duration == 1:
-                    self.state += 'u'
-                elif self.duration == 2:
-                    self.state += 'v'
-                elif self.duration == 3:
-                    self.state += 'w'
-            elif self.size == 3:
-                if self.duration == 1:
-                    self.state += 'x'
-                elif self.duration == 2:
-                    self.state += 'y'
-                elif self.duration == 3:
-                    self.state += 'z'
-        elif self.periodic == 4:
-            if self.size == 1:
-                if self.duration == 1:
-                    self.state += 'R'
-                elif self.duration == 2:
-                    self.state += 'S'
-                elif self.duration == 3:
-                    self.state += 'T'
-            elif self.size == 2:
-                if self.duration == 1:
-                    self.state += 'U'
-                elif self.duration == 2:
-                    self.state += 'V'
-                elif self.duration == 3:
-                    self.state += 'W'
-            elif self.size == 3:
-                if self.duration == 1:
-                    self.state += 'X'
-                elif self.duration == 2:
-                    self.state += 'Y'
-                elif self.duration == 3:
-                    self.state += 'Z'
-
-    def compute_symbols(self):
-        if not isinstance(self.T2, bool):
-            if self.T2 <= timedelta(seconds=5):
-                self.state += '.'
-            elif self.T2 <= timedelta(seconds=60):
-                self.state += ','
-            elif self.T2 <= timedelta(seconds=300):
-                self.state += '+'
-            elif self.T2 <= timedelta(seconds=3600):
-                self.state += '*'
-        if self.verbose > 2:
-            print '\tTD:{}, T2:{}, T1:{}, State: {}'.format(self.TD, self.T2, self.T1, self.state)
+            print '\tTD:{}, T2:{}, T1:{}, State: {}'.format(self.TD, self.T2, self.T1, self.get_state())
 
     def get_id(self):
         return self.id
 
     def __repr__(self):
-        return('{} [{}] ({}): {}'.format(self.color(self.get_id()), self.desc, self.amount_of_flows, self.state))
+        return('{} [{}] ({}): {}'.format(self.color(self.get_id()), self.desc, self.amount_of_flows, self.get_state()))
 
     def print_tuple_detected(self):
         """
         Print the tuple. The state is the state since the last detection of the tuple. Not everything
         """
-        return('{} [{}] ({}): {}  Detected as: {}'.format(self.color(self.get_id()), self.desc, self.amount_of_flows, self.get_state_detected_last(), self.get_detected_label()))
+        line = '{} [{}] ({}): {}  Detected as: {}'.format(self.color(self.get_id()), self.desc, self.amount_of_flows, self.get_state_detected_last(), self.get_detected_label())
+        if self.periodic_pattern:
+            line += '  Periodic'
+        return line
 
     def set_color(self, color):
         self.color = color
@@ -395,6 +428,35 @@ class Tuple(object):
         if self.verbose > 3:
             print '\tPrint tuple {}'.format(self.get_id())
 
+class TimeParser(object):
+    """
+    Parse the starttime of the flows to seconds since the epoch. The format is fixed by ra.conf (%Y/%m/%d %T.%f), and the
+    flows arrive sorted, so the date, hour and minute of the last flow are kept and usually only the seconds are parsed.
+    The times are taken as UTC, so there are no jumps when the daylight saving time changes.
+    """
+    def __init__(self):
+        self.minute = ''
+        self.minute_seconds = 0
+
+    def parse(self, text):
+        if len(text) != 26 or text[16] != ':' or text[19] != '.':
+            # Not the format of ra.conf. Parse it the slow way
+            return self.to_seconds(datetime.strptime(text, '%Y/%m/%d %H:%M:%S.%f'))
+        if text[:16] != self.minute:
+            self.minute_seconds = self.to_seconds(datetime.strptime(text[:16], '%Y/%m/%d %H:%M'))
+            self.minute = text[:16]
+        seconds = float(text[17:])
+        if not 0 <= seconds < 60:
+            raise ValueError('Wrong seconds in the time {}'.format(text))
+        return self.minute_seconds + seconds
+
+    def to_seconds(self, time):
+        return calendar.timegm(time.timetuple()) + time.microsecond / 1e6
+
+    def format(self, seconds):
+        """ The time as it is printed by a datetime """
+        return str(datetime.utcfromtimestamp(seconds))
+
 # Process
 
 
@@ -412,7 +474,276 @@ class Processor(multiprocessing.Process):
         self.slot_starttime = -1
         self.slot_endtime = -1
         self.slot_width = slot_width
+        # The times are in seconds since the epoch
+        self.slot_seconds = slot_width.total_seconds()
+        self.time_parser = TimeParser()
         self.dontdetect = dontdetect
+        # Look for the periodic patterns in the tuples when they are detected
+        self.periodic = False
+        self.sound = False
+        self.encoder = LetterEncoder()
+        # The tuple of the flow that started the slot. It is processed before the slot is emptied, so it is not in tuples_in_this_time_slot
+        self.first_tuple_of_slot = False
+        # Seconds without flows after which a tuple is forgotten. 0 means never
+        self.idle_time = 0
+        # The id of each tuple with the time of its last flow. After each slot its tuples are moved to the end, so the
+        # oldest are at the start and forgetting the idle tuples only visits the ones that are older than the idle time,
+        # instead of all the tuples
+        self.idle_wheel = OrderedDict()
+        # Amount of the last letters of each tuple used for the detection
+        self.window = 200
+        # The models read again in the background, ready to be used. And the folder to read after them, if asked meanwhile
+        self.new_models = False
+        self.loading_models = False
+        self.pending_reload = False
+        # Print the reloads of the models
+        self.report_reloads = True
+        self.whois_cache = 'whois.db'
+        self.whois_resolver = False
+        self.metrics = metrics.Metrics()
+        # The histograms observed with each flow. The parsing and the adding are cheaper than the timing, so only one
+        # of each 8 lines is timed
+        self.parse_times = self.metrics.get_histogram('parse_seconds')
+        self.add_flow_times = self.metrics.get_histogram('add_flow_seconds')
+        self.detect_times = self.metrics.get_histogram('detect_seconds')
+        self.timed = True
+        # Lines seen by sample(), in all the batches, so the same share is timed whatever the size of the batches
+        self.samples = 0
+        # Seconds between the stats lines, 0 means never. The file where the metrics are written each metrics_interval seconds
+        self.stats_interval = 0
+        self.metrics_file = False
+        self.metrics_interval = 10
+        # When the last stats line was printed, with the flows so far, and when the metrics were written
+        self.last_stats = time.time()
+        self.last_stats_flows = 0
+        self.last_metrics = time.time()
+        # The file where the state is saved each checkpoint_interval seconds, to continue from it after a restart. 0 only
+        # saves it at the end of the flows. The process writing the last checkpoint, if it did not finish
+        self.checkpoint_file = False
+        self.checkpoint_interval = 0
+        self.last_checkpoint = time.time()
+        self.checkpoint_writer = False
+        # Continue from the checkpoint file when starting
+        self.restore = True
+        # The flows wait up to reorder_delay seconds to be processed sorted by time, in a heap of at most reorder_size
+        # flows. 0 processes them as they arrive
+        self.reorder_delay = 0
+        self.reorder_size = 100000
+        self.reorder_buffer = []
+        self.reorder_sequence = 0
+        # The time of the newest flow received, and of the last flow taken from the heap
+        self.newest_flowtime = -1
+        self.released_flowtime = -1
+
+    def set_window(self, window):
+        """ Detect with this amount of the last letters of each tuple """
+        self.window = window
+
+    def set_idle_time(self, idle_time):
+        """ Forget the tuples without flows for this amount of seconds. 0 means never """
+        self.idle_time = idle_time
+
+    def set_whois_cache(self, file):
+        """ The SQLite file where the whois of the IPs are stored """
+        self.whois_cache = file
+
+    def get_whois_resolver(self):
+        """ The resolver is created in the process that uses it, because its threads do not survive a fork """
+        if not self.whois_resolver:
+            self.whois_resolver = whois.WhoisResolver(whois.WhoisCache(self.whois_cache))
+        return self.whois_resolver
+
+    def set_metrics(self, stats_interval, file=False):
+        """ Print the stats each stats_interval seconds, if not 0, and write the metrics in the file each metrics_interval seconds if given """
+        self.stats_interval = stats_interval
+        self.metrics_file = file
+
+    def get_metrics(self):
+        """ The metrics of the processor, with the ones kept by the models """
+        self.metrics.set('tuples', len(self.tuples))
+        if not self.dontdetect:
+            (scores, seconds) = __markov_models__.get_model_times()
+            self.metrics.set_labelled('model_scores', scores)
+            self.metrics.set_labelled('model_score_seconds', seconds)
+        return self.metrics
+
+    def get_metrics_timeout(self):
+        """ Seconds to wait for a batch of lines, so the stats and the metrics are reported even without flows. None waits forever """
+        intervals = [interval for interval in [self.stats_interval, self.metrics_file and self.metrics_interval] if interval]
+        if not intervals:
+            return None
+        return min(intervals)
+
+    def report_metrics(self, final=False):
+        """ Print the stats line and write the metrics file, when it is time """
+        now = time.time()
+        if self.stats_interval and (final or now - self.last_stats >= self.stats_interval):
+            current = self.get_metrics()
+            print current.get_stats_line(now - self.last_stats, current.get('flows') - self.last_stats_flows)
+            self.last_stats = now
+            self.last_stats_flows = current.get('flows')
+        if self.metrics_file and (final or now - self.last_metrics >= self.metrics_interval):
+            try:
+                self.get_metrics().write(self.metrics_file)
+            except IOError as inst:
+                print 'The metrics can not be written in {}: {}'.format(self.metrics_file, inst)
+            self.last_metrics = now
+
+    def sample(self):
+        """ Decide if the next line is timed. One of each 8 """
+        self.samples += 1
+        self.timed = not self.samples & 7
+
+    def get_queue_depth(self):
+        """ Batches waiting in the queue """
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # Not available in Mac OS X
+            return -1
+
+    def set_checkpoint(self, file, interval, restore=True):
+        """ Save the state in the file each interval seconds, and continue from it when starting if restore """
+        self.checkpoint_file = file
+        self.checkpoint_interval = interval
+        self.restore = restore
+
+    def get_checkpoint_key(self):
+        """ The values that should be the same to continue from a checkpoint. Other thresholds give other letters """
+        return (CHECKPOINT_VERSION, sorted(self.encoder.thresholds.items()))
+
+    def get_checkpoint_header(self):
+        """ The time slot, and the amount of tuples that follow it in the checkpoint """
+        return {'key': self.get_checkpoint_key(), 'time': time.time(), 'slot_starttime': self.slot_starttime, 'slot_endtime': self.slot_endtime,
+                'slot': self.tuples_in_this_time_slot.keys(), 'first_tuple_of_slot': self.first_tuple_of_slot and self.first_tuple_of_slot.get_id(),
+                'reorder_buffer': self.reorder_buffer, 'newest_flowtime': self.newest_flowtime, 'released_flowtime': self.released_flowtime,
+                'tuples': len(self.tuples)}
+
+    def write_checkpoint(self, chunk_size=10000):
+        """
+        Write the header, the tuples in chunks and the idle wheel in the checkpoint file. In another file that is renamed
+        at the end, so a crash never leaves the checkpoint half written
+        """
+        try:
+            with open(self.checkpoint_file + '.tmp', 'wb') as output:
+                pickler = cPickle.Pickler(output, 2)
+                pickler.dump(self.get_checkpoint_header())
+                tuples = self.tuples.itervalues()
+                while True:
+                    chunk = [tuple.get_checkpoint() for tuple in itertools.islice(tuples, chunk_size)]
+                    if not chunk:
+                        break
+                    pickler.dump(chunk)
+                    # The memo keeps all the objects pickled so far
+                    pickler.clear_memo()
+                pickler.dump(self.idle_wheel.items())
+            os.rename(self.checkpoint_file + '.tmp', self.checkpoint_file)
+            return True
+        except (IOError, OSError) as inst:
+            print 'The checkpoint can not be written in {}: {}'.format(self.checkpoint_file, inst)
+            return False
+
+    def read_checkpoint(self):
+        """ Continue from the state saved in the checkpoint file, if there is one. Only once. Return if it was read """
+        if not self.checkpoint_file or not self.restore or not os.path.isfile(self.checkpoint_file):
+            return False
+        self.restore = False
+        start = time.time()
+        # Millions of new objects make the collector run many times for nothing
+        gc.disable()
+        try:
+            with open(self.checkpoint_file, 'rb') as input:
+                unpickler = cPickle.Unpickler(input)
+                header = unpickler.load()
+                if header.get('key') != self.get_checkpoint_key():
+                    print 'The checkpoint {} was saved by another version or with other thresholds or amount of workers. Starting without it.'.format(self.checkpoint_file)
+                    return False
+                tuples = {}
+                while len(tuples) < header['tuples']:
+                    for values in unpickler.load():
+                        tuple = Tuple(values[0], self.encoder, self.window)
+                        tuple.set_verbose(self.verbose)
+                        tuple.set_checkpoint(values)
+                        tuples[tuple.get_id()] = tuple
+                idle_wheel = OrderedDict(unpickler.load())
+        except Exception as inst:
+            print 'The checkpoint {} can not be read ({} {}). Starting without it.'.format(self.checkpoint_file, type(inst).__name__, inst)
+            return False
+        finally:
+            gc.enable()
+        self.tuples = tuples
+        self.idle_wheel = idle_wheel
+        self.slot_starttime = header['slot_starttime']
+        self.slot_endtime = header['slot_endtime']
+        self.tuples_in_this_time_slot = dict((id, tuples[id]) for id in header['slot'])
+        self.first_tuple_of_slot = tuples.get(header['first_tuple_of_slot'], False)
+        self.reorder_buffer = header.get('reorder_buffer', [])
+        self.reorder_sequence = max([sequence for (flowtime, sequence, values) in self.reorder_buffer] or [0])
+        self.newest_flowtime = header.get('newest_flowtime', -1)
+        self.released_flowtime = header.get('released_flowtime', -1)
+        if self.verbose and tuples:
+            print 'Restored {} tuples from {} in {:.2f} seconds. Saved {}.'.format(len(tuples), self.checkpoint_file, time.time() - start, time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(header['time'])))
+        return True
+
+    def checkpoint(self, now=False):
+        """
+        Save the state each checkpoint_interval seconds, or now. A forked process writes it from its copy on write of
+        the memory, so the flows are processed meanwhile. Call between two flows
+        """
+        if not self.checkpoint_file:
+            return
+        if not now and (not self.checkpoint_interval or time.time() - self.last_checkpoint < self.checkpoint_interval or self.is_writing_checkpoint()):
+            return
+        # Only one at a time
+        self.is_writing_checkpoint(True)
+        start = time.time()
+        self.last_checkpoint = start
+        # The forked process gets a copy of the lines not printed yet
+        sys.stdout.flush()
+        pid = os.fork()
+        if not pid:
+            code = 1
+            try:
+                # The collector would touch all the objects, and copy their memory
+                gc.disable()
+                if self.write_checkpoint():
+                    code = 0
+            except Exception as inst:
+                print '\tProblem with checkpoint()'
+                print type(inst)     # the exception instance
+                print inst.args      # arguments stored in .args
+                print inst           # __str__ allows args to printed directly
+            finally:
+                # Never go back to the processing of the flows
+                sys.stdout.flush()
+                os._exit(code)
+        self.checkpoint_writer = pid
+        self.metrics.inc('checkpoints')
+        self.metrics.observe('checkpoint_pause_seconds', time.time() - start)
+
+    def is_writing_checkpoint(self, wait=False):
+        """ If the process writing the last checkpoint did not finish. Wait for it if asked """
+        if not self.checkpoint_writer:
+            return False
+        (pid, status) = os.waitpid(self.checkpoint_writer, 0 if wait else os.WNOHANG)
+        if not pid:
+            return True
+        if status:
+            self.metrics.inc('checkpoint_errors')
+        self.checkpoint_writer = False
+        return False
+
+    def set_sound(self, sound):
+        """ Play a sound when something is detected. The pygame mixer should be ready """
+        self.sound = sound
+
+    def set_periodic(self, periodic):
+        """ Show in the report the tuples with a periodic pattern in their window. The patterns are the ones of the models detection """
+        self.periodic = periodic
+
+    def set_encoder(self, encoder):
+        """ The encoder with the thresholds for the letters of the tuples """
+        self.encoder = encoder
 
     def get_tuple(self, tuple4):
         """ Get the values and return the correct tuple for them """
@@ -421,84 +752,268 @@ class Processor(multiprocessing.Process):
             # We already have this connection
         except KeyError:
             # First time for this connection
-            tuple = Tuple(tuple4)
+            tuple = Tuple(tuple4, self.encoder, self.window)
             tuple.set_verbose(self.verbose)
             self.tuples[tuple4] = tuple
         return tuple
 
-    def process_out_of_time_slot(self, column_values):
+    def get_tuple4(self, column_values):
+        """ The id of the tuple of a flow. The flows of a sensor have its id after the 13 columns, and it is part of the tuple """
+        if len(column_values) > 13:
+            return column_values[3]+'-'+column_values[6]+'-'+column_values[7]+'-'+column_values[2]+'-'+column_values[13]
+        return column_values[3]+'-'+column_values[6]+'-'+column_values[7]+'-'+column_values[2]
+
+    def get_slot_header(self, slot_starttime, slot_endtime, amount_of_connections):
+        return 'Slot Started: {}, finished: {}. ({} connections)'.format(self.time_parser.format(slot_starttime), self.time_parser.format(slot_endtime), amount_of_connections)
+
+    def get_tuples_of_slot(self):
+        """ The tuples that received flows in this time slot. Only them can change since the last report """
+        tuples = self.tuples_in_this_time_slot.values()
+        if self.first_tuple_of_slot and self.first_tuple_of_slot.get_id() not in self.tuples_in_this_time_slot:
+            tuples.append(self.first_tuple_of_slot)
+        return tuples
+
+    def report_time_slot(self):
+        """ Generate the lines to print about the tuples when the time slot finishes """
+        for tuple in self.get_tuples_of_slot():
+            if tuple.amount_of_flows > self.amount and tuple.should_be_printed:
+                if self.get_whois and (not tuple.desc or tuple.desc == whois.PENDING):
+                    tuple.set_whois_data(self.get_whois_resolver().get_whois(tuple.dst_ip))
+                yield tuple.print_tuple_detected()
+            # Clear the color because we already print it
+            if tuple.color == red:
+                tuple.set_color(yellow)
+            # After printing the tuple in this time slot, we should not print it again unless we see some of its flows.
+            if tuple.should_be_printed:
+                tuple.dont_print()
+
+    def forget_idle_tuples(self, flowtime):
+        """ Forget the tuples without flows for more than the idle time. Call after each timeslot finishes, with the time of the new flow """
+        forgotten = 0
+        if not self.idle_time:
+            return forgotten
+        for tuple in sorted(self.get_tuples_of_slot(), key=lambda tuple: tuple.datetime):
+            # Move it to the end
+            self.idle_wheel.pop(tuple.get_id(), None)
+            self.idle_wheel[tuple.get_id()] = tuple.datetime
+        limit = flowtime - self.idle_time
+        while self.idle_wheel:
+            (id, seen) = next(self.idle_wheel.iteritems())
+            if seen >= limit:
+                break
+            del self.idle_wheel[id]
+            if self.tuples.pop(id, False):
+                forgotten += 1
+        return forgotten
+
+    def forget_tuples(self, flowtime):
+        """ Forget the idle tuples after each timeslot. Return the line to print about them """
+        idle = self.forget_idle_tuples(flowtime)
+        return self.get_forgotten_line(idle, len(self.tuples))
+
+    def get_forgotten_line(self, idle, kept):
+        return 'Forgotten tuples: {} idle. {} tuples kept.'.format(idle, kept)
+
+    def process_first_flow_of_slot(self, column_values, flowtime):
+        """ Put the last flow received in the next slot, because it overcome the threshold and it was not processed """
+        tuple4 = self.get_tuple4(column_values)
+        tuple = self.get_tuple(tuple4)
+        if self.verbose:
+            if tuple.get_state_len() == 0:
+                tuple.set_color(red)
+        start = time.time()
+        tuple.add_new_flow(column_values, flowtime)
+        if self.timed:
+            self.add_flow_times.observe(time.time() - start)
+        self.first_tuple_of_slot = tuple
+        # Detect the first flow of the future timeslot
+        self.detect(tuple)
+
+    def process_out_of_time_slot(self, column_values, flowtime):
         """
         Process the tuples when we are out of the time slot
         """
         # Outside the slot
+        start = time.time()
         if self.verbose:
-            print cyan('Slot Started: {}, finished: {}. ({} connections)'.format(self.slot_starttime, self.slot_endtime, len(self.tuples_in_this_time_slot)))
-            for tuple4 in self.tuples:
-                tuple = self.get_tuple(tuple4)
-                if tuple.amount_of_flows > self.amount and tuple.should_be_printed:
-                    if not tuple.desc and self.get_whois:
-                        tuple.get_whois_data()
-                    print tuple.print_tuple_detected()
-                # Clear the color because we already print it
-                if tuple.color == red:
-                    tuple.set_color(yellow)
-                # After printing the tuple in this time slot, we should not print it again unless we see some of its flows.
-                if tuple.should_be_printed:
-                    tuple.dont_print()
-        # After each timeslot finishes forget the tuples that are too big. This is useful when a tuple has a very very long state that is not so useful to us. Later we forget it when we detect it or after a long time.
-        ids_to_delete = []
-        for tuple in self.tuples:
-            # We cut the strings of letters regardless of it being detected before.
-            if self.tuples[tuple].amount_of_flows > 100:
-                if self.verbose > 3:
-                    print 'Delete all the letters because there were more than 100 and it was detected. Start again with this tuple.'
-                ids_to_delete.append(self.tuples[tuple].get_id())
-        # Actually delete them
-        for id in ids_to_delete:
-            del self.tuples[id]
+            print cyan(self.get_slot_header(self.slot_starttime, self.slot_endtime, len(self.tuples_in_this_time_slot)))
+            for line in self.report_time_slot():
+                print line
+        forgotten_line = self.forget_tuples(flowtime)
+        if self.verbose > 1:
+            print forgotten_line
+        self.metrics.observe('slot_flush_seconds', time.time() - start)
         # Move the time slot
-        self.slot_starttime = datetime.strptime(column_values[0], '%Y/%m/%d %H:%M:%S.%f')
-        self.slot_endtime = self.slot_starttime + self.slot_width
+        self.slot_starttime = flowtime
+        self.slot_endtime = self.slot_starttime + self.slot_seconds
+        self.process_first_flow_of_slot(column_values, flowtime)
+        # Empty the tuples in this time window
+        self.tuples_in_this_time_slot = {}
 
-        # Put the last flow received in the next slot, because it overcome the threshold and it was not processed
-        tuple4 = column_values[3]+'-'+column_values[6]+'-'+column_values[7]+'-'+column_values[2]
+    def process_flow(self, column_values, flowtime):
+        """ Process a flow inside the time slot """
+        tuple4 = self.get_tuple4(column_values)
         tuple = self.get_tuple(tuple4)
+        self.tuples_in_this_time_slot[tuple.get_id()] = tuple
         if self.verbose:
-            if len(tuple.state) == 0:
+            if tuple.get_state_len() == 0:
                 tuple.set_color(red)
-        tuple.add_new_flow(column_values)
-        # Detect the first flow of the future timeslot
+        start = time.time()
+        tuple.add_new_flow(column_values, flowtime)
+        if self.timed:
+            self.add_flow_times.observe(time.time() - start)
+        # Detection
         self.detect(tuple)
-        # Empty the tuples in this time window
-        self.tuples_in_this_time_slot = {}
+
+    def add_flow_to_slot(self, column_values, flowtime):
+        """ Process the flow in the current time slot, or finish the slot if the flow is after it. The flows before it are ignored """
+        if self.slot_starttime == -1:
+            # First flow
+            self.slot_starttime = flowtime
+            self.slot_endtime = self.slot_starttime + self.slot_seconds
+        if flowtime >= self.slot_starttime and flowtime < self.slot_endtime:
+            # Inside the slot
+            self.process_flow(column_values, flowtime)
+        elif flowtime > self.slot_endtime:
+            # Out of time slot
+            self.metrics.inc('slots')
+            self.process_out_of_time_slot(column_values, flowtime)
+        else:
+            # Before the slot
+            self.metrics.inc('ignored_flows')
+
+    def set_reorder(self, delay, size=100000):
+        """ Keep the flows up to delay seconds to process them sorted by time, and at most size of them. 0 processes them as they arrive """
+        self.reorder_delay = delay
+        self.reorder_size = size
+
+    def reorder(self, column_values, flowtime):
+        """
+        The flows that can be processed after this one arrived, sorted by time. The flows wait in a heap until a flow
+        delay seconds newer arrives, or until the heap is full. A flow older than the last one taken from the heap is
+        late, and it is processed at once as without reordering: in its tuple if its slot is still open, or ignored
+        """
+        if flowtime < self.released_flowtime:
+            self.metrics.inc('late_flows')
+            return [(column_values, flowtime)]
+        # The number keeps the order of arrival of the flows with the same time
+        self.reorder_sequence += 1
+        heapq.heappush(self.reorder_buffer, (flowtime, self.reorder_sequence, column_values))
+        watermark = self.newest_flowtime - self.reorder_delay
+        released = []
+        while self.reorder_buffer and (self.reorder_buffer[0][0] <= watermark or len(self.reorder_buffer) > self.reorder_size):
+            if self.reorder_buffer[0][0] > watermark:
+                self.metrics.inc('reorder_overflows')
+            (released_flowtime, sequence, values) = heapq.heappop(self.reorder_buffer)
+            released.append((values, released_flowtime))
+        if released:
+            self.released_flowtime = released[-1][1]
+        return released
+
+    def release_flows(self):
+        """ All the flows waiting to be reordered, sorted by time. At the end of the flows """
+        released = [(values, flowtime) for (flowtime, sequence, values) in sorted(self.reorder_buffer)]
+        self.reorder_buffer = []
+        if released:
+            self.released_flowtime = released[-1][1]
+        return released
+
+    def count_flows(self):
+        """ The flows processed so far are the lines that were not dropped, without the ones waiting to be reordered """
+        self.metrics.set('reorder_buffer', len(self.reorder_buffer))
+        self.metrics.set('flows', self.metrics.get('lines') - self.metrics.get('parse_errors') - self.metrics.get('ignored_flows') - len(self.reorder_buffer))
+
+    def end_of_batch(self):
+        """ Called after each batch of lines was processed """
+        pass
+
+    def stop(self):
+        """ Called after the last flow was processed """
+        if self.verbose > 1 and not self.dontdetect:
+            print __markov_models__.get_stats()
+        self.is_writing_checkpoint(True)
+        self.report_metrics(True)
+
+    def reload_models(self, folder):
+        """ Read the models again in the background. They are used when ready, between two batches of flows """
+        if self.dontdetect:
+            return
+        if self.loading_models:
+            # Read them again after the current reload, to get the last changes
+            self.pending_reload = folder
+            return
+        if self.report_reloads:
+            print 'Reloading the models from {}.'.format(folder)
+        self.loading_models = True
+        loader = threading.Thread(target=self.load_models, args=(folder,))
+        loader.daemon = True
+        loader.start()
+
+    def load_models(self, folder):
+        try:
+            models = __markov_models__.reload_models(folder, quiet=True)
+            if not models:
+                print 'The models in {} can not be reloaded. Still using the previous ones.'.format(folder)
+                self.loading_models = False
+            else:
+                self.new_models = models
+        except Exception as inst:
+            print '\tProblem with load_models()'
+            print type(inst)     # the exception instance
+            print inst.args      # arguments stored in .args
+            print inst           # __str__ allows args to printed directly
+            self.loading_models = False
+
+    def swap_models(self):
+        """ Use the reloaded models, if they are ready. The tuples keep their scores for the models that did not change """
+        if not self.new_models:
+            return
+        (unchanged, new, removed) = __markov_models__.swap_models(self.new_models)
+        self.metrics.inc('reloads')
+        self.new_models = False
+        self.loading_models = False
+        if self.report_reloads:
+            print 'Models reloaded: {} unchanged, {} new, {} removed.'.format(unchanged, new, removed)
+        if self.pending_reload:
+            folder = self.pending_reload
+            self.pending_reload = False
+            self.reload_models(folder)
+
+    def set_detection(self, tuple, detected, label):
+        """ Mark the tuple with the result of its detection """
+        if detected:
+            # Change color
+            tuple.set_color(magenta)
+            # Set the detection label
+            tuple.set_detected_label(label)
+            """
+            # Set the detection state len
+            tuple.set_best_model_matching_len(statelen)
+            """
+            if self.verbose > 5:
+                print 'Last flow: Detected with {}'.format(label)
+            # Play sound
+            if self.sound:
+                pygame.mixer.music.play()
+        elif not detected:
+            # Not detected by any reason. No model matching but also the state len is too short.
+            tuple.unset_detected_label()
+            if self.verbose > 5:
+                print 'Last flow: Not detected'
+            tuple.dont_print()
 
     def detect(self, tuple):
         """
         Detect behaviors
         """
         try:
+            if self.periodic:
+                tuple.set_periodic_pattern(__markov_models__.is_tuple_periodic(tuple))
             if not self.dontdetect:
+                start = time.time()
                 (detected, label, statelen) = __markov_models__.detect(tuple, self.verbose)
-                if detected:
-                    # Change color
-                    tuple.set_color(magenta)
-                    # Set the detection label
-                    tuple.set_detected_label(label)
-                    """
-                    # Set the detection state len
-                    tuple.set_best_model_matching_len(statelen)
-                    """
-                    if self.verbose > 5:
-                        print 'Last flow: Detected with {}'.format(label)
-                    # Play sound
-                    if args.sound:
-                        pygame.mixer.music.play()
-                elif not detected:
-                    # Not detected by any reason. No model matching but also the state len is too short.
-                    tuple.unset_detected_label()
-                    if self.verbose > 5:
-                        print 'Last flow: Not detected'
-                    tuple.dont_print()
+                self.detect_times.observe(time.time() - start)
+                self.set_detection(tuple, detected, label)
         except Exception as inst:
             print '\tProblem with detect()'
             print type(inst)     # the exception instance
@@ -508,48 +1023,90 @@ class Processor(multiprocessing.Process):
 
     def run(self):
         try:
+            self.read_checkpoint()
             while True:
-                if not self.queue.empty():
-                    line = self.queue.get()
-                    if 'stop' != line:
+                # Wait until a batch of lines arrives
+                start = time.time()
+                try:
+                    lines = self.queue.get(True, self.get_metrics_timeout())
+                except Empty:
+                    lines = False
+                self.metrics.inc('queue_wait_seconds', time.time() - start)
+                if not lines:
+                    # No flows for a while
+                    self.report_metrics()
+                    continue
+                sensor = False
+                if isinstance(lines, tuple) and lines[0] == 'flows':
+                    # The lines of a sensor
+                    (sensor, lines) = lines[1:]
+                elif isinstance(lines, tuple):
+                    # Not lines but a message for the processor
+                    if lines[0] == 'reload':
+                        self.reload_models(lines[1])
+                    continue
+                self.swap_models()
+                if 'stop' != lines:
+                    start = time.time()
+                    self.metrics.inc('batches')
+                    self.metrics.inc('lines', len(lines))
+                    self.metrics.set('queue_depth', self.get_queue_depth())
+                    for line in lines:
                         # Process this flow
+                        self.sample()
+                        parse_start = time.time()
                         nline = ','.join(line.strip().split(',')[:13])
                         try:
-                            column_values = nline.split(',')
+                            values = nline.split(',')
                             # 0:starttime, 1:dur, 2:proto, 3:saddr, 4:sport, 5:dir, 6:daddr: 7:dport, 8:state, 9:stos,  10:dtos, 11:pkts, 12:bytes
-                            if self.slot_starttime == -1:
-                                # First flow
-                                try:
-                                    self.slot_starttime = datetime.strptime(column_values[0], '%Y/%m/%d %H:%M:%S.%f')
-                                except ValueError:
-                                    continue
-                                self.slot_endtime = self.slot_starttime + self.slot_width
-                            flowtime = datetime.strptime(column_values[0], '%Y/%m/%d %H:%M:%S.%f')
-                            if flowtime >= self.slot_starttime and flowtime < self.slot_endtime:
-                                # Inside the slot
-                                tuple4 = column_values[3]+'-'+column_values[6]+'-'+column_values[7]+'-'+column_values[2]
-                                tuple = self.get_tuple(tuple4)
-                                self.tuples_in_this_time_slot[tuple.get_id()] = tuple
-                                if self.verbose:
-                                    if len(tuple.state) == 0:
-                                        tuple.set_color(red)
-                                tuple.add_new_flow(column_values)
-                                # Detection
-                                self.detect(tuple)
-                            elif flowtime > self.slot_endtime:
-                                # Out of time slot
-                                self.process_out_of_time_slot(column_values)
-                        except UnboundLocalError:
-                            print 'Probable empty file.'
-                    else:
-                        try:
-                            # Process the last flows in the last time slot
-                            self.process_out_of_time_slot(column_values)
+                            # The starttime is parsed only here, and its seconds are used in the rest of the processing
+                            try:
+                                flowtime = self.time_parser.parse(values[0])
+                            except ValueError:
+                                # E.g. the header of the file. The last flow is still the previous one
+                                self.metrics.inc('parse_errors')
+                                continue
+                            if len(values) < 13:
+                                # E.g. a line cut in the middle
+                                self.metrics.inc('parse_errors')
+                                continue
+                            if sensor:
+                                values.append(sensor)
+                            if self.timed:
+                                self.parse_times.observe(time.time() - parse_start)
+                            if flowtime < self.newest_flowtime:
+                                self.metrics.inc('out_of_order_flows')
+                            else:
+                                self.newest_flowtime = flowtime
+                            if not self.reorder_delay:
+                                column_values = values
+                                self.add_flow_to_slot(column_values, flowtime)
+                                continue
+                            for (column_values, flowtime) in self.reorder(values, flowtime):
+                                self.add_flow_to_slot(column_values, flowtime)
                         except UnboundLocalError:
                             print 'Probable empty file.'
-                            # Here for some reason we still miss the last flow. But since is just one i will let it go for now.
-                        # Just Return
-                        return True
+                    self.checkpoint()
+                    self.end_of_batch()
+                    self.count_flows()
+                    self.metrics.observe('batch_seconds', time.time() - start)
+                    self.report_metrics()
+                else:
+                    # The flows still waiting to be reordered
+                    for (column_values, flowtime) in self.release_flows():
+                        self.add_flow_to_slot(column_values, flowtime)
+                    self.count_flows()
+                    # Save the state before the last time slot is reported, to continue it after a restart
+                    self.checkpoint(True)
+                    try:
+                        # Process the last flows in the last time slot
+                        self.process_out_of_time_slot(column_values, flowtime)
+                    except UnboundLocalError:
+                        print 'Probable empty file.'
+                        # Here for some reason we still miss the last flow. But since is just one i will let it go for now.
+                    self.stop()
+                    # Just Return
+                    return True
 
         except KeyboardInterrupt:
             return True
@@ -561,59 +1118,931 @@ class Processor(multiprocessing.Process):
             sys.exit(1)
 
 
+class LineBatcher(object):
+    """
+    Send the lines to the processor in batches, so the queue is not used for each line.
+    A batch that is not full is sent after a short delay, so the flows of a quiet network still arrive.
+    The queue should be bounded. When it is full the reader waits for the processor instead of keeping the lines in memory.
+    """
+    def __init__(self, queue, size=100, delay=0.5, report_every=0, sensor=False):
+        self.queue = queue
+        self.size = size
+        self.delay = delay
+        self.lines = []
+        # The batches of a sensor go with its id
+        self.sensor = sensor
+        # Seconds the reader waited because the queue was full, and the most batches seen waiting
+        self.blocked_time = 0
+        self.max_depth = 0
+        # Print the stats each this amount of seconds. 0 means never
+        self.report_every = report_every
+        self.last_report = time.time()
+        self.condition = threading.Condition()
+        flusher = threading.Thread(target=self.flush_after_delay)
+        flusher.daemon = True
+        flusher.start()
+
+    def put(self, line):
+        with self.condition:
+            self.lines.append(line)
+            if len(self.lines) >= self.size:
+                self.flush()
+            elif len(self.lines) == 1:
+                # Wake up the flusher
+                self.condition.notify()
+
+    def flush(self):
+        """ Send the lines so far. Call with the condition acquired """
+        if self.lines:
+            self.send(('flows', self.sensor, self.lines) if self.sensor else self.lines)
+            self.lines = []
+
+    def send(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Full:
+            # The processor is behind. Wait for it
+            start = time.time()
+            self.queue.put(message)
+            self.blocked_time += time.time() - start
+        self.max_depth = max(self.max_depth, self.get_depth())
+        if self.report_every and time.time() - self.last_report >= self.report_every:
+            print self.get_stats()
+            self.last_report = time.time()
+
+    def get_depth(self):
+        """ Batches waiting in the queue """
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # Not available in Mac OS X
+            return -1
+
+    def get_stats(self):
+        return 'Ingest queue: {} batches waiting (max {}). Blocked {:.2f} seconds waiting for the processor.'.format(self.get_depth(), self.max_depth, self.blocked_time)
+
+    def flush_after_delay(self):
+        while True:
+            with self.condition:
+                # Sleep until there are lines waiting
+                while not self.lines:
+                    self.condition.wait()
+            time.sleep(self.delay)
+            with self.condition:
+                self.flush()
+
+    def close(self, stop=True):
+        """ Send the lines left and the stop """
+        with self.condition:
+            self.flush()
+            if stop:
+                self.send('stop')
+
+    def send_message(self, message):
+        """ Send the lines so far and then this message for the processor, which is a tuple """
+        with self.condition:
+            self.flush()
+            self.send(message)
+
+
+class ModelsWatcher(threading.Thread):
+    """
+    Ask the processor to reload the models when slips receives a SIGHUP, or when the files of the folder or the bundle
+    change. They are checked each interval of seconds. 0 means only with the signal.
+    """
+    def __init__(self, batcher, folder, interval=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.batcher = batcher
+        self.folder = folder
+        self.interval = interval
+        self.event = threading.Event()
+
+    def get_signature(self):
+        """ The names, sizes and modification times of the model files """
+        try:
+            if os.path.isfile(self.folder):
+                files = [self.folder]
+            else:
+                files = [os.path.join(self.folder, name) for name in sorted(os.listdir(self.folder))]
+            return [(file, os.path.getsize(file), os.path.getmtime(file)) for file in files if os.path.isfile(file)]
+        except OSError:
+            return False
+
+    def handle_signal(self, signum, frame):
+        # Only wake up the watcher. The lines can not be sent from the handler, the reader may be sending them
+        self.event.set()
+
+    def run(self):
+        signature = self.get_signature()
+        while True:
+            if self.interval:
+                self.event.wait(self.interval)
+            else:
+                self.event.wait()
+            signaled = self.event.is_set()
+            self.event.clear()
+            new_signature = self.get_signature()
+            if signaled or new_signature != signature:
+                signature = new_signature
+                self.batcher.send_message(('reload', self.folder))
+
+
+class Sensor(object):
+    """
+    A source of flows read by the SensorsReader: the output of a command (cmd:ra -S host:port ...), a TCP server that
+    sends the flows (tcp:host:port), a file or a FIFO, or - for the standard input. Its lines are sent with its id.
+    """
+    def __init__(self, id, source, batcher):
+        self.id = id
+        self.source = source
+        self.batcher = batcher
+        self.fd = -1
+        self.process = False
+        self.socket = False
+        # The start of the next line, not received yet
+        self.rest = ''
+        self.lines = 0
+
+    def open(self):
+        """ Start reading the sensor. A FIFO does not wait here for a writer, the select waits for its lines. Return if it could be opened """
+        try:
+            if self.source.startswith('cmd:'):
+                self.process = subprocess.Popen(self.source[4:], shell=True, stdout=subprocess.PIPE)
+                self.fd = self.process.stdout.fileno()
+            elif self.source.startswith('tcp:'):
+                (host, port) = self.source[4:].rsplit(':', 1)
+                self.socket = socket.create_connection((host, int(port)))
+                self.fd = self.socket.fileno()
+            elif self.source == '-':
+                self.fd = sys.stdin.fileno()
+            else:
+                self.fd = os.open(self.source, os.O_RDONLY | os.O_NONBLOCK)
+            return True
+        except (OSError, IOError, ValueError, socket.error) as inst:
+            print 'The sensor {} ({}) can not be read: {}'.format(self.id, self.source, inst)
+            return False
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """ Send the lines received so far. False when the sensor finished """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as inst:
+            # Nothing to read yet
+            if inst.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            print 'The sensor {} ({}) can not be read: {}'.format(self.id, self.source, inst)
+            data = ''
+        if not data:
+            if self.rest:
+                self.batcher.put(self.rest)
+                self.lines += 1
+            return False
+        lines = (self.rest + data).split('\n')
+        # The last one is not complete
+        self.rest = lines.pop()
+        for line in lines:
+            self.batcher.put(line)
+        self.lines += len(lines)
+        return True
+
+    def close(self):
+        """ Send the lines left, without the stop, and close the sensor """
+        self.batcher.close(False)
+        if self.socket:
+            self.socket.close()
+        elif self.process:
+            self.process.stdout.close()
+            self.process.wait()
+        elif self.source != '-':
+            os.close(self.fd)
+
+
+class SensorsReader(object):
+    """
+    Read the flows of several sensors at the same time in one loop with select, instead of the standard input. Each
+    sensor has its own batches, which go with its id, and the id is part of its tuples, so the same connection seen by
+    two sensors are two tuples. When the queue is full the loop waits, so all the sensors wait for the processor.
+    """
+    def __init__(self, queue, sources, size=100, report_every=0):
+        self.sensors = []
+        for (index, source) in enumerate(sources):
+            # id=source, or a number is used as id
+            match = re.match(r'([\w.]+)=(.+)$', source)
+            (id, source) = match.groups() if match else ('sensor{}'.format(index + 1), source)
+            if id in [sensor.id for sensor in self.sensors]:
+                raise ValueError('The id {} is used by two sensors.'.format(id))
+            self.sensors.append(Sensor(id, source, LineBatcher(queue, size, sensor=id)))
+        # Print the stats each this amount of seconds. 0 means never
+        self.report_every = report_every
+        self.last_report = time.time()
+
+    def run(self):
+        """ Read the sensors until all of them finish """
+        sensors = [sensor for sensor in self.sensors if sensor.open()]
+        while sensors:
+            try:
+                readable = select.select(sensors, [], [], 1.0)[0]
+            except select.error as inst:
+                # Interrupted by a signal, like the SIGHUP to reload the models
+                if inst.args[0] == errno.EINTR:
+                    continue
+                raise
+            for sensor in readable:
+                if not sensor.read():
+                    sensor.close()
+                    sensors.remove(sensor)
+                    print 'Finished receiving the flows of the sensor {}: {} lines.'.format(sensor.id, sensor.lines)
+            if self.report_every and time.time() - self.last_report >= self.report_every:
+                print self.get_stats()
+                self.last_report = time.time()
+
+    def get_stats(self):
+        """ The stats of the queue, with the time all the sensors waited for the processor """
+        batchers = [sensor.batcher for sensor in self.sensors]
+        return 'Ingest queue: {} batches waiting (max {}). Blocked {:.2f} seconds waiting for the processor.'.format(
+            batchers[0].get_depth(), max([batcher.max_depth for batcher in batchers]), sum([batcher.blocked_time for batcher in batchers]))
+
+    def send_message(self, message):
+        """ Send a message for the processor, e.g. to reload the models """
+        self.sensors[0].batcher.send_message(message)
+
+    def close(self):
+        """ Send the lines left of all the sensors and the stop """
+        for sensor in self.sensors:
+            sensor.batcher.close(False)
+        self.sensors[0].batcher.close()
+
+
+class Worker(Processor):
+    """
+    A process that handles the tuples of one shard. The time slots are decided by the ShardedProcessor, and the
+    lines to print when a slot finishes are sent back to it.
+    """
+    def __init__(self, queue, report_queue, slot_width, get_whois, verbose, amount, dontdetect):
+        Processor.__init__(self, queue, slot_width, get_whois, verbose, amount, dontdetect)
+        self.report_queue = report_queue
+        # The sharded processor already prints the reloads
+        self.report_reloads = False
+
+    def close_time_slot(self, slot, column_values, flowtime, owner):
+        """ Send the report of the slot and start the next one. Only the owner of the flow that started the new slot processes it """
+        start = time.time()
+        lines = []
+        if self.verbose:
+            lines = list(self.report_time_slot())
+        amount_of_connections = len(self.tuples_in_this_time_slot)
+        idle = self.forget_idle_tuples(flowtime)
+        self.metrics.observe('slot_flush_seconds', time.time() - start)
+        # The metrics of the worker so far go with the report. A copy, because the queue sends it later
+        self.report_queue.put((slot, amount_of_connections, lines, (idle, len(self.tuples)), self.name, self.get_metrics().copy()))
+        self.first_tuple_of_slot = False
+        if owner:
+            self.process_first_flow_of_slot(column_values, flowtime)
+        # Empty the tuples in this time window
+        self.tuples_in_this_time_slot = {}
+
+    def run(self):
+        try:
+            self.read_checkpoint()
+            while True:
+                # Wait until a batch of messages arrives
+                messages = self.queue.get()
+                self.swap_models()
+                for message in messages:
+                    if message[0] == 'flow':
+                        # One of each 8 flows is timed, as the Processor does with the lines
+                        self.sample()
+                        self.process_flow(message[1], message[2])
+                    elif message[0] == 'slot':
+                        self.close_time_slot(message[1], message[2], message[3], message[4])
+                    elif message[0] == 'reload':
+                        self.reload_models(message[1])
+                    elif message[0] == 'checkpoint':
+                        self.checkpoint(True)
+                    else:
+                        self.stop()
+                        return True
+        except KeyboardInterrupt:
+            return True
+        except Exception as inst:
+            print '\tProblem with Worker()'
+            print type(inst)     # the exception instance
+            print inst.args      # arguments stored in .args
+            print inst           # __str__ allows args to printed directly
+            sys.exit(1)
+
+
+class ShardedProcessor(Processor):
+    """
+    A processor that only decides the time slots and sends each flow to one of several Workers, by the hash of its tuple.
+    The reports of the workers for each slot are merged and printed as the single Processor does.
+    """
+    def __init__(self, queue, slot_width, get_whois, verbose, amount, dontdetect, amount_of_workers, queue_size=0):
+        Processor.__init__(self, queue, slot_width, get_whois, verbose, amount, dontdetect)
+        self.amount_of_workers = amount_of_workers
+        # Max batches waiting for each worker. When they are full the sharded processor waits
+        self.queue_size = queue_size
+        self.workers = []
+        # The messages for each worker not sent yet
+        self.messages = []
+        self.report_queue = False
+        # The number of the current slot and the start and end time of the slots that were not printed yet
+        self.slot_number = 0
+        self.slot_times = {}
+        # The last metrics sent by each worker
+        self.worker_metrics = {}
+
+    def get_worker(self, column_values):
+        return hash(self.get_tuple4(column_values)) % self.amount_of_workers
+
+    def process_flow(self, column_values, flowtime):
+        self.messages[self.get_worker(column_values)].append(('flow', column_values, flowtime))
+
+    def process_out_of_time_slot(self, column_values, flowtime):
+        self.slot_times[self.slot_number] = (self.slot_starttime, self.slot_endtime)
+        owner = self.get_worker(column_values)
+        for index in range(self.amount_of_workers):
+            self.messages[index].append(('slot', self.slot_number, column_values, flowtime, index == owner))
+        self.slot_number += 1
+        # Move the time slot
+        self.slot_starttime = flowtime
+        self.slot_endtime = self.slot_starttime + self.slot_seconds
+
+    def reload_models(self, folder):
+        """ Each worker reloads its models """
+        if self.dontdetect:
+            return
+        print 'Reloading the models from {} in the workers.'.format(folder)
+        for index in range(self.amount_of_workers):
+            self.messages[index].append(('reload', folder))
+        self.end_of_batch()
+
+    def get_checkpoint_key(self):
+        """ The tuples of each worker depend on the amount of workers """
+        return Processor.get_checkpoint_key(self) + (self.amount_of_workers,)
+
+    def checkpoint(self, now=False):
+        """ Each worker saves its tuples in its own file, after the same flow. The sharded processor only saves the time slot """
+        if not self.checkpoint_file:
+            return
+        if not now and (not self.checkpoint_interval or time.time() - self.last_checkpoint < self.checkpoint_interval):
+            return
+        self.last_checkpoint = time.time()
+        for messages in self.messages:
+            messages.append(('checkpoint',))
+        self.write_checkpoint()
 
+    def merge_reports(self):
+        """ Print the reports of each slot, in order, when all the workers sent theirs """
+        reports = {}
+        next_slot = 0
+        while True:
+            report = self.report_queue.get()
+            if report == 'stop':
+                return True
+            (slot, amount_of_connections, lines, forgotten, name, worker_metrics) = report
+            self.worker_metrics[name] = worker_metrics
+            reports.setdefault(slot, []).append((amount_of_connections, lines, forgotten))
+            while len(reports.get(next_slot, [])) == self.amount_of_workers:
+                slot_reports = reports.pop(next_slot)
+                (slot_starttime, slot_endtime) = self.slot_times.pop(next_slot)
+                if self.verbose:
+                    print cyan(self.get_slot_header(slot_starttime, slot_endtime, sum([amount for (amount, lines, forgotten) in slot_reports])))
+                    for (amount, lines, forgotten) in slot_reports:
+                        for line in lines:
+                            print line
+                if self.verbose > 1:
+                    # The idle and kept tuples of all the workers
+                    print self.get_forgotten_line(*[sum(values) for values in zip(*[forgotten for (amount, lines, forgotten) in slot_reports])])
+                next_slot += 1
+
+    def run(self):
+        self.report_queue = Queue()
+        # The workers continue from their checkpoints only if the time slot was restored
+        restored = self.read_checkpoint()
+        for index in range(self.amount_of_workers):
+            worker = Worker(Queue(self.queue_size), self.report_queue, self.slot_width, self.get_whois, self.verbose, self.amount, self.dontdetect)
+            worker.set_sound(self.sound)
+            worker.set_periodic(self.periodic)
+            worker.set_encoder(self.encoder)
+            worker.set_idle_time(self.idle_time)
+            worker.set_window(self.window)
+            worker.set_whois_cache(self.whois_cache)
+            if self.checkpoint_file:
+                worker.set_checkpoint('{}.{}'.format(self.checkpoint_file, index), 0, restored)
+            worker.start()
+            self.workers.append(worker)
+            self.messages.append([])
+        merger = threading.Thread(target=self.merge_reports)
+        merger.start()
+        try:
+            return Processor.run(self)
+        finally:
+            self.stop()
+            merger.join()
+            self.report_metrics(True)
+
+    def get_metrics(self):
+        """ The metrics of the sharded processor and the last ones of each worker, added """
+        merged = metrics.Metrics()
+        merged.merge(self.metrics)
+        for worker_metrics in self.worker_metrics.values():
+            merged.merge(worker_metrics)
+        return merged
+
+    def end_of_batch(self):
+        """ Send the messages of the batch to each worker at once """
+        for index, worker in enumerate(self.workers):
+            if self.messages[index]:
+                worker.queue.put(self.messages[index])
+                self.messages[index] = []
+
+    def stop(self):
+        """ Wait for the workers and the last reports """
+        if not self.workers:
+            return
+        self.end_of_batch()
+        for worker in self.workers:
+            worker.queue.put([('stop',)])
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.report_queue.put('stop')
+
+
+class OfflineProcessor(Processor):
+    """
+    Analyse a whole binetflow file, with the same output as sending it to the Processor through the standard input.
+    The file is read in chunks of lines, and the letters of the flows of each chunk are computed with numpy, tuple by tuple.
+    The time slots and the tuples are handled as usual, but each tuple is detected once when the slot finishes instead
+    of with each flow. Its report only depends on the detection of its last flow, and the detection of the whole state
+    gives the same result as the running one.
+    """
+    def __init__(self, slot_width, get_whois, verbose, amount, dontdetect, chunk_size=500000):
+        Processor.__init__(self, False, slot_width, get_whois, verbose, amount, dontdetect)
+        self.chunk_size = chunk_size
+        # The number of each tuple id
+        self.codes = {}
+        # The time and the time since the previous flow of the last flow of each tuple number. NaN if not known
+        self.last_times = numpy.zeros(0)
+        self.last_T2 = numpy.zeros(0)
+
+    def get_code(self, tuple4):
+        try:
+            return self.codes[tuple4]
+        except KeyError:
+            self.codes[tuple4] = len(self.codes)
+            return self.codes[tuple4]
+
+    def parse_lines(self, lines):
+        """ The tuple, the time, the size and the duration of each flow. The lines that can not be parsed are skipped """
+        flows = []
+        for line in lines:
+            column_values = line.strip().split(',')[:13]
+            if len(column_values) < 13:
+                # E.g. a line cut in the middle
+                continue
+            try:
+                flowtime = self.time_parser.parse(column_values[0])
+                tuple4 = self.get_tuple4(column_values)
+            except ValueError:
+                continue
+            try:
+                size = float(column_values[12])
+            except ValueError:
+                # It can happen that we dont have this value in the binetflow
+                size = 0.0
+            try:
+                duration = float(column_values[1])
+            except ValueError:
+                duration = 0.0
+            flows.append((tuple4, flowtime, size, duration))
+        return flows
+
+    def get_slot_actions(self, times):
+        """ What the Processor does with each flow: 0 ignore it, 1 process it in the slot, 2 start a new slot with it. Same comparisons """
+        actions = []
+        (starttime, endtime) = (self.slot_starttime, self.slot_endtime)
+        for flowtime in times:
+            if starttime == -1:
+                # First flow
+                (starttime, endtime) = (flowtime, flowtime + self.slot_seconds)
+            if flowtime >= starttime and flowtime < endtime:
+                actions.append(1)
+            elif flowtime > endtime:
+                actions.append(2)
+                (starttime, endtime) = (flowtime, flowtime + self.slot_seconds)
+            else:
+                actions.append(0)
+        return actions
+
+    def get_letters(self, codes, times, sizes, durations):
+        """ The letters of the flows, as the encoder computes them with the previous flows of each tuple, and without them """
+        codes = numpy.array(codes, dtype=int)
+        times = numpy.array(times)
+        if len(self.codes) > len(self.last_times):
+            # New tuples, without previous flows
+            new = numpy.full(len(self.codes) - len(self.last_times), numpy.nan)
+            self.last_times = numpy.concatenate((self.last_times, new))
+            self.last_T2 = numpy.concatenate((self.last_T2, new))
+        # The flows of each tuple together, in the order they arrived
+        order = numpy.argsort(codes, kind='mergesort')
+        codes = codes[order]
+        times = times[order]
+        first = numpy.ones(len(codes), dtype=bool)
+        first[1:] = codes[1:] != codes[:-1]
+        previous_times = numpy.empty(len(codes))
+        previous_times[1:] = times[:-1]
+        previous_times[first] = self.last_times[codes[first]]
+        # Rounded as the tuples round them
+        T2 = numpy.array([round(value, 6) for value in (times - previous_times).tolist()])
+        T1 = numpy.empty(len(codes))
+        T1[1:] = T2[:-1]
+        T1[first] = self.last_T2[codes[first]]
+        # Keep the last flow of each tuple for the next chunk
+        last = numpy.ones(len(codes), dtype=bool)
+        last[:-1] = first[1:]
+        self.last_times[codes[last]] = times[last]
+        self.last_T2[codes[last]] = T2[last]
+        encoded = self.encoder.encode_columns(T1, T2, numpy.array(sizes)[order], numpy.array(durations)[order])
+        # Back to the order of the flows
+        result = []
+        for values in encoded:
+            unsorted = numpy.empty(len(codes), dtype=object)
+            unsorted[order] = values
+            result.append(unsorted.tolist())
+        return zip(*result)
+
+    def add_flow(self, flow, flowtime):
+        """ Add a flow to its tuple. The flow has the tuple id, its letters, and its letter and symbol for when the tuple is new """
+        (tuple4, letters, plain, symbol) = flow
+        tuple = self.get_tuple(tuple4)
+        if self.verbose:
+            if tuple.get_state_len() == 0:
+                tuple.set_color(red)
+        # The tuple may be new, or forgotten and created again. Then its first two flows do not have the previous times
+        if tuple.amount_of_flows == 0:
+            letters = plain
+        elif tuple.amount_of_flows == 1:
+            letters = plain + symbol
+        tuple.add_encoded_flow(letters, flowtime)
+        return tuple
+
+    def process_flow(self, flow, flowtime):
+        tuple = self.add_flow(flow, flowtime)
+        self.tuples_in_this_time_slot[tuple.get_id()] = tuple
+
+    def process_first_flow_of_slot(self, flow, flowtime):
+        self.first_tuple_of_slot = self.add_flow(flow, flowtime)
+
+    def report_time_slot(self):
+        """ Detect the tuples that received flows, with their state after the last one, before reporting them """
+        if not self.dontdetect or self.periodic:
+            for tuple in self.get_tuples_of_slot():
+                # The tuples with few flows are not printed anyway
+                if tuple.should_be_printed and tuple.amount_of_flows > self.amount:
+                    self.detect(tuple)
+        return Processor.report_time_slot(self)
+
+    def detect(self, tuple):
+        if self.periodic:
+            tuple.set_periodic_pattern(__markov_models__.is_tuple_periodic(tuple))
+        if not self.dontdetect:
+            (detected, label, statelen) = __markov_models__.detect_state(tuple.get_state(), tuple.get_protocol(), self.verbose)
+            self.set_detection(tuple, detected, label)
+
+    def read(self, file):
+        """ Analyse all the flows of the file """
+        last = False
+        with open(file) as input:
+            while True:
+                flows = self.parse_lines(itertools.islice(input, self.chunk_size))
+                if not flows:
+                    break
+                (tuples, times, sizes, durations) = zip(*flows)
+                actions = self.get_slot_actions(times)
+                kept = [index for (index, action) in enumerate(actions) if action]
+                encoded = self.get_letters([self.get_code(tuples[index]) for index in kept], [times[index] for index in kept],
+                                           [sizes[index] for index in kept], [durations[index] for index in kept])
+                for (index, (letters, plain, symbol)) in zip(kept, encoded):
+                    flow = (tuples[index], letters, plain, symbol)
+                    if self.slot_starttime == -1:
+                        self.slot_starttime = times[index]
+                        self.slot_endtime = self.slot_starttime + self.slot_seconds
+                    if actions[index] == 1:
+                        self.process_flow(flow, times[index])
+                    else:
+                        self.process_out_of_time_slot(flow, times[index])
+                last = (tuples[-1], times[-1])
+        if not last:
+            print 'Probable empty file.'
+            return False
+        # The Processor reports the last slot with the last flow, which is processed again afterwards
+        self.process_out_of_time_slot((last[0], '', '', ''), last[1])
+        self.stop()
+        return True
+
+
+class FileAnalyser(OfflineProcessor):
+    """
+    An OfflineProcessor for one of several files analysed at the same time. What it prints is kept, split by time slot,
+    so the reports of all the files can be merged in time order. The flows and the detections are counted.
+    """
+    def __init__(self, slot_width, get_whois, verbose, amount, dontdetect, chunk_size=500000):
+        OfflineProcessor.__init__(self, slot_width, get_whois, verbose, amount, dontdetect, chunk_size)
+        self.output = cStringIO.StringIO()
+        # The start time of each slot, with what was printed until its report
+        self.reports = []
+        self.amount_of_flows = 0
+        # The amount of detections of each label
+        self.labels = {}
+
+    def keep_output(self, slot_starttime):
+        self.reports.append((slot_starttime, self.output.getvalue()))
+        self.output.seek(0)
+        self.output.truncate()
+
+    def parse_lines(self, lines):
+        flows = OfflineProcessor.parse_lines(self, lines)
+        self.amount_of_flows += len(flows)
+        return flows
+
+    def set_detection(self, tuple, detected, label):
+        if detected:
+            self.labels[label] = self.labels.get(label, 0) + 1
+        OfflineProcessor.set_detection(self, tuple, detected, label)
+
+    def process_out_of_time_slot(self, flow, flowtime):
+        """ As the Processor, but the report of the slot is kept with its start time """
+        if self.verbose:
+            print cyan(self.get_slot_header(self.slot_starttime, self.slot_endtime, len(self.tuples_in_this_time_slot)))
+            for line in self.report_time_slot():
+                print line
+        forgotten_line = self.forget_tuples(flowtime)
+        if self.verbose > 1:
+            print forgotten_line
+        self.keep_output(self.slot_starttime)
+        # Move the time slot
+        self.slot_starttime = flowtime
+        self.slot_endtime = self.slot_starttime + self.slot_seconds
+        self.process_first_flow_of_slot(flow, flowtime)
+        # Empty the tuples in this time window
+        self.tuples_in_this_time_slot = {}
+
+    def analyse(self, file):
+        """ Analyse all the flows of the file, keeping what is printed instead of printing it """
+        stdout = sys.stdout
+        sys.stdout = self.output
+        try:
+            self.read(file)
+        finally:
+            sys.stdout = stdout
+        # What was printed after the last report goes with it
+        (slot_starttime, text) = self.reports.pop() if self.reports else (-1, '')
+        self.reports.append((slot_starttime, text + self.output.getvalue()))
+
+
+def analyse_file(task):
+    """ Analyse one of several files, in a process of the pool. Return what is needed to merge its report with the others """
+    (index, file, args, encoder) = task
+    start = time.time()
+    analyser = FileAnalyser(timedelta(minutes=args.width), args.datawhois, args.verbose, args.amount, args.dontdetect)
+    analyser.set_sound(args.sound)
+    analyser.set_periodic(bool(args.periodic))
+    analyser.set_encoder(encoder)
+    analyser.set_idle_time(args.idle * 60)
+    analyser.set_window(args.letters)
+    analyser.set_whois_cache(args.whoiscache)
+    analyser.analyse(file)
+    return (index, analyser.reports, analyser.amount_of_flows, analyser.labels, time.time() - start)
+
+
+def analyse_files(files, processes, args, encoder):
+    """
+    Analyse the files at the same time in a pool of processes, each one on its own. The progress is printed as they
+    finish, and then the reports of all the files merged in time order, with the detections of each label
+    """
+    start = time.time()
+    # Each process analyses one file and finishes, so nothing is kept from the previous file
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    results = [None] * len(files)
+    try:
+        tasks = [(index, file, args, encoder) for (index, file) in enumerate(files)]
+        for (done, result) in enumerate(pool.imap_unordered(analyse_file, tasks), 1):
+            (index, reports, amount_of_flows, labels, seconds) = result
+            results[index] = result
+            print 'Analysed {} ({} of {}): {} flows in {:.1f} seconds. {:.0f} flows/sec.'.format(files[index], done, len(files), amount_of_flows, seconds, amount_of_flows / max(seconds, 0.001))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        return False
+    except Exception as inst:
+        print '\tProblem with analyse_files()'
+        print type(inst)     # the exception instance
+        print inst.args      # arguments stored in .args
+        print inst           # __str__ allows args to printed directly
+        pool.terminate()
+        return False
+    finally:
+        pool.join()
+    seconds = time.time() - start
+    print
+    # The slots of all the files by their start time. The slots of each file are already in order
+    previous = None
+    for (slot_starttime, index, text) in heapq.merge(*[[(slot_starttime, result[0], text) for (slot_starttime, text) in result[1]] for result in results]):
+        if not text:
+            continue
+        if index != previous:
+            print cyan('File {}'.format(files[index]))
+            previous = index
+        sys.stdout.write(text)
+    amount_of_flows = sum([result[2] for result in results])
+    print
+    print 'Analysed {} files in {} processes: {} flows in {:.1f} seconds. {:.0f} flows/sec.'.format(len(files), processes, amount_of_flows, seconds, amount_of_flows / max(seconds, 0.001))
+    labels = {}
+    for result in results:
+        for (label, amount) in result[3].iteritems():
+            labels[label] = labels.get(label, 0) + amount
+    print 'Detections: {}'.format(sum(labels.values()))
+    for (label, amount) in sorted(labels.iteritems(), key=lambda item: (-item[1], item[0])):
+        print '\t{}: {}'.format(label, amount)
+    return True
 
 
 ####################
 # Main
 ####################
-print 'Stratosphere Linux IPS. Version {}\n'.format(version)
-
-# Parse the parameters
-parser = argparse.ArgumentParser()
-parser.add_argument('-a', '--amount', help='Minimum amount of flows that should be in a tuple to be printed.', action='store', required=False, type=int, default=-1)
-parser.add_argument('-v', '--verbose', help='Amount of verbosity.', action='store', default=1, required=False, type=int)
-parser.add_argument('-w', '--width', help='Width of the time slot used for the analysis. In minutes.', action='store', default=5, required=False, type=int)
-parser.add_argument('-d', '--datawhois', help='Get and show the whois info for the destination IP in each tuple', action='store_true', default=False, required=False)
-parser.add_argument('-D', '--dontdetect', help='Dont detect the malicious behavior in the flows using the models. Just print the connections.', default=False, action='store_true', required=False)
-parser.add_argument('-f', '--folder', help='Folder with models to apply for detection.', action='store', required=False)
-parser.add_argument('-s', '--sound', help='Play a small sound when a periodic connections is found.', action='store_true', default=False, required=False)
-args = parser.parse_args()
-
-# Global shit for whois cache. The tuple needs to access it but should be shared, so global
-whois_cache = {}
-
-if args.dontdetect:
-    print 'Warning: No detections will be done. Only the behaviors are printed.'
-    print
-    # If the folder with models was specified, just ignore it
-    args.folder = False
-
-# Do we need sound?
-if args.sound:
-    import pygame.mixer
-    pygame.mixer.init(44100)
-    pygame.mixer.music.load('periodic.ogg')
-
-
-# Read the folder with models if specified
-if args.folder:
-    onlyfiles = [f for f in listdir(args.folder) if isfile(join(args.folder, f))]
-    print 'Detecting malicious behaviors with the following models:'
-    for file in onlyfiles:
-        __markov_models__.set_model_to_detect(join(args.folder, file))
-
-# Create the queue
-queue = Queue()
-# Create the thread and start it
-processorThread = Processor(queue, timedelta(minutes=args.width), args.datawhois, args.verbose, args.amount, args.dontdetect)
-processorThread.start()
-
-# Just put the lines in the queue as fast as possible
-for line in sys.stdin:
-    queue.put(line)
-    #print 'A: {}'.format(queue.qsize())
-print 'Finished receiving the input.'
-# Shall we wait? Not sure. Seems that not
-time.sleep(1)
-queue.put('stop')
+if __name__ == '__main__':
+    print 'Stratosphere Linux IPS. Version {}\n'.format(version)
+
+    # Parse the parameters
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--amount', help='Minimum amount of flows that should be in a tuple to be printed.', action='store', required=False, type=int, default=-1)
+    parser.add_argument('-v', '--verbose', help='Amount of verbosity.', action='store', default=1, required=False, type=int)
+    parser.add_argument('-w', '--width', help='Width of the time slot used for the analysis. In minutes.', action='store', default=5, required=False, type=int)
+    parser.add_argument('-d', '--datawhois', help='Get and show the whois info for the destination IP in each tuple', action='store_true', default=False, required=False)
+    parser.add_argument('-C', '--whoiscache', help='SQLite file where the whois info is stored, shared by all the processes and kept between runs.', action='store', default='whois.db', required=False)
+    parser.add_argument('-D', '--dontdetect', help='Dont detect the malicious behavior in the flows using the models. Just print the connections.', default=False, action='store_true', required=False)
+    parser.add_argument('-f', '--folder', help='Folder with models to apply for detection. It can also be a bundle of models created with -c.', action='store', required=False)
+    parser.add_argument('-c', '--compile', help='Compile the models of the folder given with -f into a bundle in this file, which loads much faster, and exit.', action='store', required=False)
+    parser.add_argument('-r', '--reload', help='Seconds between the checks of the models given with -f. If they changed they are reloaded without stopping. 0 only reloads them with a SIGHUP.', action='store', default=0, required=False, type=int)
+    parser.add_argument('-e', '--exhaustive', help='Score the whole state of each tuple against all the models, instead of stopping with a model as soon as it can not match. The detections are the same, but slower.', action='store_true', default=False, required=False)
+    parser.add_argument('-b', '--batch', help='Score all the models of a protocol at once with numpy. Faster when there are many models.', action='store_true', default=False, required=False)
+    parser.add_argument('-W', '--workers', help='Amount of processes that handle the tuples. The flows are sent to each one by the hash of its tuple.', action='store', default=1, required=False, type=int)
+    parser.add_argument('-B', '--batchsize', help='Amount of lines sent to the processor at once.', action='store', default=100, required=False, type=int)
+    parser.add_argument('-Q', '--queuesize', help='Max amount of batches of lines waiting to be processed. When there are more, the reading of the flows waits.', action='store', default=1000, required=False, type=int)
+    parser.add_argument('-L', '--letters', help='Amount of the last letters of each tuple used for the detection. The older ones are forgotten.', action='store', default=200, required=False, type=int)
+    parser.add_argument('-I', '--idle', help='Minutes without flows after which a tuple is forgotten. 0 never forgets them.', action='store', default=1440, required=False, type=int)
+    parser.add_argument('-t', '--thresholds', help='Thresholds for the letters of the tuples, separated by commas. E.g. td1=0.2,ts2=1500. See LetterEncoder for the names and defaults.', action='store', required=False)
+    parser.add_argument('-R', '--read', help='Analyse these binetflow files offline, instead of the flows of the standard input. Much faster, with the same output. Needs numpy. Several files, or a quoted glob, are analysed at the same time in -W processes (one per core by default) and their reports merged in time order.', action='store', nargs='+', required=False)
+    parser.add_argument('-S', '--stats', help='Seconds between the lines with the stats of the processing: flows per second, dropped lines, queue depth and the time of each stage. 0 never prints them.', action='store', default=0, required=False, type=int)
+    parser.add_argument('-M', '--metrics', help='File where the metrics of the processing are written every 10 seconds, in the text format of Prometheus.', action='store', required=False)
+    parser.add_argument('-i', '--inputs', help='Read the flows of several sensors at the same time instead of the standard input. Each one is id=source, where the source is cmd:command (e.g. cmd:ra -S host:902 ...), tcp:host:port, a file or a FIFO. The id is added to the tuples.', action='store', nargs='+', required=False)
+    parser.add_argument('-O', '--reorder', help='Seconds that the flows wait to be processed sorted by their time, for sources that send them out of order. The flows older than the ones already processed are counted as late. 0 processes them as they arrive.', action='store', default=0, required=False, type=float)
+    parser.add_argument('-K', '--checkpoint', help='File where the state of the tuples is saved, to continue from it when slips starts again. With -W each worker saves its tuples in the file followed by its number.', action='store', required=False)
+    parser.add_argument('-k', '--checkpointinterval', help='Seconds between the checkpoints given with -K. They are written in the background. 0 only saves the state at the end of the flows.', action='store', default=300, required=False, type=int)
+    parser.add_argument('-P', '--periodic', help='File with periodic patterns of letters, one per line (e.g. r.r.r.), added to the basic ones. The tuples with one of them in their window are shown as Periodic.', action='store', required=False)
+    parser.add_argument('-s', '--sound', help='Play a small sound when a periodic connections is found.', action='store_true', default=False, required=False)
+    args = parser.parse_args()
+
+    # Compile the models in a bundle and exit
+    if args.compile:
+        if not args.folder:
+            print 'The folder with the models to compile should be given with -f.'
+            sys.exit(-1)
+        if not __markov_models__.set_models_folder(args.folder):
+            sys.exit(-1)
+        __markov_models__.write_models_bundle(args.compile)
+        sys.exit(0)
+
+    if args.dontdetect:
+        print 'Warning: No detections will be done. Only the behaviors are printed.'
+        print
+        # If the folder with models was specified, just ignore it
+        args.folder = False
+
+    # The thresholds of the letters
+    try:
+        encoder = LetterEncoder(LetterEncoder.parse_thresholds(args.thresholds))
+    except ValueError as inst:
+        print 'Wrong thresholds: {}'.format(inst)
+        sys.exit(-1)
+
+    # Only states with more than 3 letters are detected
+    if args.letters < 4:
+        print 'The amount of letters of each tuple should be at least 4.'
+        sys.exit(-1)
+
+    # The whois needs the ipwhois library
+    if args.datawhois and not whois.ipwhois:
+        print 'The ipwhois library is not installed. pip install ipwhois. The whois info is not shown.'
+        args.datawhois = False
+
+    # Our own periodic patterns
+    if args.periodic:
+        try:
+            __markov_models__.read_periodic_patterns(args.periodic)
+        except IOError as inst:
+            print 'The periodic patterns can not be read: {}'.format(inst)
+            sys.exit(-1)
+
+    # Do we need sound?
+    if args.sound:
+        import pygame.mixer
+        pygame.mixer.init(44100)
+        pygame.mixer.music.load('periodic.ogg')
+
+
+    # Read the folder with models if specified
+    if args.folder:
+        print 'Detecting malicious behaviors with the following models:'
+        if not __markov_models__.set_models_folder(args.folder):
+            sys.exit(-1)
+        __markov_models__.set_batch(args.batch)
+        __markov_models__.set_early_abandon(not args.exhaustive)
+
+    # Analyse a file offline
+    if args.read:
+        if not numpy:
+            print 'The numpy library is not installed. pip install numpy. Send the file to the standard input instead.'
+            sys.exit(-1)
+        if args.checkpoint:
+            print 'Warning: The files are analysed from the start, without the checkpoint.'
+        if args.reorder:
+            print 'Warning: The flows of the files are not reordered. They should be sorted by time.'
+        if args.inputs:
+            print 'Warning: The sensors are not read, only the files.'
+        files = []
+        for pattern in args.read:
+            files.extend(sorted(glob.glob(pattern)) or [pattern])
+        for file in files:
+            if not os.path.isfile(file):
+                print 'The file {} does not exist.'.format(file)
+                sys.exit(-1)
+        if len(files) > 1:
+            if not analyse_files(files, args.workers if args.workers > 1 else min(len(files), multiprocessing.cpu_count()), args, encoder):
+                sys.exit(1)
+            sys.exit(0)
+        processor = OfflineProcessor(timedelta(minutes=args.width), args.datawhois, args.verbose, args.amount, args.dontdetect)
+        processor.set_sound(args.sound)
+        processor.set_periodic(bool(args.periodic))
+        processor.set_encoder(encoder)
+        processor.set_idle_time(args.idle * 60)
+        processor.set_window(args.letters)
+        processor.set_whois_cache(args.whoiscache)
+        processor.read(files[0])
+        sys.exit(0)
+
+    # Create the queue
+    queue = Queue(args.queuesize)
+    # Read several sensors instead of the standard input
+    if args.inputs:
+        try:
+            reader = SensorsReader(queue, args.inputs, args.batchsize, report_every=60 if args.verbose > 1 else 0)
+        except ValueError as inst:
+            print inst
+            sys.exit(-1)
+    # Create the thread and start it
+    if args.workers > 1:
+        processorThread = ShardedProcessor(queue, timedelta(minutes=args.width), args.datawhois, args.verbose, args.amount, args.dontdetect, args.workers, args.queuesize)
+    else:
+        processorThread = Processor(queue, timedelta(minutes=args.width), args.datawhois, args.verbose, args.amount, args.dontdetect)
+    processorThread.set_sound(args.sound)
+    processorThread.set_periodic(bool(args.periodic))
+    processorThread.set_encoder(encoder)
+    processorThread.set_idle_time(args.idle * 60)
+    processorThread.set_window(args.letters)
+    processorThread.set_whois_cache(args.whoiscache)
+    processorThread.set_metrics(args.stats, args.metrics)
+    processorThread.set_reorder(args.reorder)
+    if args.checkpoint:
+        processorThread.set_checkpoint(args.checkpoint, args.checkpointinterval)
+    processorThread.start()
+
+    # Just put the lines in the queue as fast as possible, in batches
+    # Report the queue each minute when verbose
+    if args.inputs:
+        batcher = reader
+    else:
+        batcher = LineBatcher(queue, args.batchsize, report_every=60 if args.verbose > 1 else 0)
+    # Reload the models with a SIGHUP, and when they change if asked
+    if args.folder:
+        watcher = ModelsWatcher(batcher, args.folder, args.reload)
+        signal.signal(signal.SIGHUP, watcher.handle_signal)
+        # Do not interrupt the reading of the flows
+        signal.siginterrupt(signal.SIGHUP, False)
+        watcher.start()
+    if args.inputs:
+        reader.run()
+    else:
+        for line in sys.stdin:
+            batcher.put(line)
+    print 'Finished receiving the input.'
+    print batcher.get_stats()
+    # Shall we wait? Not sure. Seems that not
+    time.sleep(1)
+    batcher.close()
@@ -5,6 +5,20 @@
 
 import math
 import sys
+from array import array
+
+# The letters that the states of the tuples can have: the 0 of the long gaps, the letters of each periodicity and the time symbols
+ALPHABET = '0123456789abcdefghiABCDEFGHIrstuvwxyzRSTUVWXYZ.,+*'
+SYMBOLS = dict((letter, index) for (index, letter) in enumerate(ALPHABET))
+# Any other letter gets the last index, which has no transitions in any compiled matrix
+OTHER = len(ALPHABET)
+SIZE = len(ALPHABET) + 1
+
+
+def encode(states):
+    """ Return the number of each letter in the alphabet """
+    return [SYMBOLS.get(letter, OTHER) for letter in states]
+
 
 class Matrix(dict):
     """ The basic matrix object """
@@ -109,3 +123,52 @@ def maximum_likelihood_probabilities(states, order=1):
         #for value in matrix:
         #    print value, matrix[value]
     return (init_vector, matrix)
+
+
+class CompiledMatrix(object):
+    """
+    The log probs of a Matrix and its init vector in dense tables indexed by the number of each letter.
+    The transitions that are not in the matrix already have the penalty, so walking a state is only indexing.
+    """
+    def __init__(self, init_vector, matrix, penalty):
+        self.penalty = penalty
+        # The letters that are not in the init vector do not influence the prob
+        self.init_vector = array('d', [0.0]) * SIZE
+        # The transition from letter1 to letter2 is in the position letter1 * SIZE + letter2
+        self.transitions = array('d', [penalty]) * (SIZE * SIZE)
+        for letter in init_vector:
+            self.init_vector[self.get_symbol(letter)] = math.log(init_vector[letter])
+        for (letter1, letter2) in matrix:
+            self.transitions[self.get_symbol(letter1) * SIZE + self.get_symbol(letter2)] = math.log(float(matrix[(letter1, letter2)]))
+
+    @classmethod
+    def from_tables(cls, init_vector, transitions, penalty):
+        """ A compiled matrix with these tables, as they were already computed. Used to load the bundles of models """
+        if len(init_vector) != SIZE or len(transitions) != SIZE * SIZE:
+            raise ValueError('The tables are not of the size of the alphabet')
+        compiled = cls.__new__(cls)
+        compiled.penalty = penalty
+        compiled.init_vector = init_vector
+        compiled.transitions = transitions
+        return compiled
+
+    def get_symbol(self, letter):
+        try:
+            return SYMBOLS[letter]
+        except KeyError:
+            raise ValueError('The letter {} is not in the alphabet'.format(letter))
+
+    def compute_probability(self, symbols):
+        """
+        Log prob of generating the encoded states. The same value that the Model of the detection computes
+        with the Matrix: the init vector prob of the first letter plus the prob or the penalty of each transition.
+        """
+        if not symbols:
+            return self.penalty
+        transitions = self.transitions
+        probability = self.init_vector[symbols[0]]
+        previous = symbols[0] * SIZE
+        for symbol in symbols[1:]:
+            probability += transitions[previous + symbol]
+            previous = symbol * SIZE
+        return probability